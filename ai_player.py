@@ -21,7 +21,16 @@ _ROUND_START_DELAY = 5.0
 
 
 class Player(object):
-  def __init__(self, secret, player_info):
+  def __init__(self, secret, player_info, rng=random, clock=time.time):
+    """Makes an AI to play as the registered player.
+
+    Args:
+      rng: A random.Random to choose moves with, or the random module.
+      clock: A function returning the time in seconds, for when to start
+          rounds.
+    """
+    self._rng = rng
+    self._clock = clock
     self._secret = secret
     self._info = player_info
     self._round_start_time = None
@@ -57,8 +66,8 @@ class Player(object):
   def _MaybeStartRound(self, game_state, game_server):
     if game_state.stage == game_pb2.Stage.COLLECT_PLAYERS:
       if self._round_start_time is None:
-        self._round_start_time = time.time()
-      elif time.time() - self._round_start_time > _ROUND_START_DELAY:
+        self._round_start_time = self._clock()
+      elif self._clock() - self._round_start_time > _ROUND_START_DELAY:
         logging.info('AI %s starts the round.', self._info.name)
         game_server.Action(self._secret)
         self._round_start_time += _ROUND_START_DELAY  # Prevent repeat actions.
@@ -77,11 +86,14 @@ class Player(object):
         break
 
     player_head = None
-    if self._grid is None:
+    if self._grid is None or new_game_state.full_update:
       self._grid = common.MakeGrid(new_game_state.size)
     for block in new_game_state.block_update:
       self._grid[block.pos.x][block.pos.y] = block
-      if block.player_id == self._info.player_id:
+      # Updates are unordered; tails and rockets also carry a player_id.
+      if (block.type in (game_pb2.Block.PLAYER_HEAD, game_pb2.Block.MINE)
+          and block.HasField('player_id')
+          and block.player_id == self._info.player_id):
         player_head = block
     if not player_head:
       logging.warning(
@@ -136,7 +148,7 @@ class Player(object):
         (safe_directions, True)):
       if possible_directions:
         if default_dir not in possible_directions:
-          new_dir = random.choice(list(possible_directions))
+          new_dir = self._rng.choice(list(possible_directions))
         shoot = should_shoot
         break
     if new_dir != default_dir:
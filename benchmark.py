@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""Headless throughput benchmarks for the Nuke Snake simulation.
+
+The default suite plays AI-only games directly through controller.Controller,
+for every combination of the given world sizes, player counts, modes and
+starting rounds, and writes JSON results including per-phase tick times.
+
+Example:
+  # Benchmark the default matrix, saving results for later comparison.
+  %(prog)s --output bench.json
+  # Benchmark big worlds with many players in CLEAR_MINES mode only.
+  %(prog)s --sizes 400x200 --players 8 30 --modes CLEAR_MINES
+  # Measure world update generation alone at several world sizes, against
+  # scanning every cell each tick.
+  %(prog)s --suite world --sizes 100x30 200x50 400x200
+  # Compare height-map blur implementations.
+  %(prog)s --suite height_map
+  # Measure how many requests per second the network server can read.
+  %(prog)s --suite requests --players 1 8 32
+  # Compare wire encodings of blocks, as protos or packed.
+  %(prog)s --suite codec --sizes 100x30 200x50 1000x500
+  # Compare compressing updates with and without a trained dictionary.
+  %(prog)s --suite compression --sizes 100x30 200x50 --ticks 3000
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import socket
+import sys
+import time
+
+from common import game_pb2, network_pb2
+import ai_player
+import common
+import compression
+import controller
+import height_map
+import network
+import profiling
+import train_dictionary
+import world
+
+
+_B = game_pb2.Block
+
+
+def _ParseSize(size_str):
+  width, _, height = size_str.partition('x')
+  return int(width), int(height)
+
+
+def BenchmarkController(
+    width, height, num_players, mode, starting_round, num_ticks, seed=0):
+  """Plays an AI-only game for num_ticks and returns a dict of results.
+
+  Only the controller's work (Step and GetGameState) is timed, not the AIs'.
+  The game is seeded, so its state_digest of all updates only changes with
+  the simulation, for regression diffing.
+  """
+  timer = profiling.PhaseTimer()
+  game = controller.Controller(
+      width, height, mode, starting_round, phase_timer=timer, seed=seed)
+  ai_rng = random.Random(seed)
+  secrets = []
+  ais = []
+  for i in xrange(num_players):
+    secret = name = 'ai%d' % i
+    info = game_pb2.PlayerInfo(player_id=game.Register(secret, name), name=name)
+    secrets.append(secret)
+    ais.append(ai_player.Player(secret, info, rng=ai_rng))
+  timer.Reset()  # Exclude setup, such as the first terrain generation.
+
+  last_hash = None
+  rounds = set()
+  digest = hashlib.md5()
+  for _ in xrange(num_ticks):
+    with timer.Phase('total'):
+      game.Step()
+      last_hash, state = game.GetGameState(last_hash)
+    if state:
+      digest.update(state.SerializeToString())
+      rounds.add(state.round_num)
+      for ai in ais:
+        ai.UpdateAndDoCommands(state, game)
+      if state.stage == game_pb2.Stage.COLLECT_PLAYERS:
+        game.Action(secrets[0])  # Start right away rather than after AI delay.
+
+  seconds_by_phase = dict(timer.seconds_by_phase)
+  total_seconds = seconds_by_phase.pop('total')
+  return {
+      'width': width,
+      'height': height,
+      'players': num_players,
+      'mode': game_pb2.Mode.Id.Name(mode),
+      'starting_round': starting_round,
+      'ticks': num_ticks,
+      'rounds_played': len(rounds),
+      'ticks_per_sec': num_ticks / total_seconds,
+      'seconds_by_phase': seconds_by_phase,
+      'state_digest': digest.hexdigest(),
+  }
+
+
+def _RunWithPeakMemory(fn, *args):
+  """Runs fn in a new process so that peak memory is measured for it alone.
+
+  Returns:
+    fn's result dict, with 'peak_rss_kb' added.
+  """
+  results = multiprocessing.Queue()
+  def Run():
+    result = fn(*args)
+    # Note ru_maxrss is in bytes rather than KB on Mac OS X.
+    result['peak_rss_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+    results.put(result)
+  process = multiprocessing.Process(target=Run)
+  process.start()
+  result = results.get()
+  process.join()
+  return result
+
+
+def BenchmarkWorldUpdates(
+    width, height, num_heads, num_ticks, full_scan=False, seed=0):
+  """Returns ticks/sec for moving heads and generating their world updates.
+
+  With full_scan, every tick's updates are instead found as before updated
+  cells were tracked, for a baseline to compare against: each change is put
+  in a grid of the world's size, which is scanned and then replaced. (Getting
+  the changes to put there is not timed.)
+  """
+  rng = random.Random(seed)
+  w = world.World(width, height, rng=rng)
+  w.ClearBlocksAndRebuildTerrain(None)
+  list(w.GenerateAndClearUpdates())  # Initial full update is not measured.
+  for key in xrange(num_heads):
+    w.SetPlayerHead(key, _B(
+        type=_B.PLAYER_HEAD,
+        pos=w.GetRandomPosClearOfTerrain(),
+        direction=game_pb2.Coordinate(
+            x=rng.choice((-1, 1)), y=rng.choice((-1, 0, 1))),
+        player_id=key))
+
+  updates_grid = common.MakeGrid(w.size)
+  untimed_seconds = 0.0
+  t = time.time()
+  for tick in xrange(num_ticks):
+    for head in w.IterAllPlayerHeads():
+      old_pos = game_pb2.Coordinate(x=head.pos.x, y=head.pos.y)
+      w.AdvanceBlock(head)
+      w.SetTerrain(_B(
+          type=_B.PLAYER_TAIL,
+          pos=old_pos,
+          last_viable_tick=tick + 30,
+          player_id=head.player_id))
+    w.ExpireBlocks(tick)
+    if full_scan:
+      t0 = time.time()
+      updates = list(w.GenerateAndClearUpdates())
+      untimed_seconds += time.time() - t0
+      for block in updates:
+        updates_grid[block.pos.x][block.pos.y] = block
+      list(block for row in updates_grid for block in row if block)
+      updates_grid = common.MakeGrid(w.size)
+    else:
+      list(w.GenerateAndClearUpdates())
+  return num_ticks / (time.time() - t - untimed_seconds)
+
+
+def BenchmarkServerReads(num_clients, num_requests, burst_size=200):
+  """Returns requests/sec handled by network.Server._ReadClientRequests.
+
+  Local sockets send MOVE requests in bursts small enough that the server's
+  receive buffer does not overflow, and only reading them is timed.
+  """
+  server = network.Server(
+      '127.0.0.1', 0, 100, 30, game_pb2.Mode.BATTLE, 0)
+  server_addr = server._sock._sock.getsockname()
+  encoder = network._ProtoSocket(
+      socket.socket(socket.AF_INET, socket.SOCK_DGRAM), network_pb2.Response)
+  socks = []
+  moves = []
+  for i in xrange(num_clients):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    secret = name = 'client%d' % i
+    for data in encoder.Encode(network_pb2.Request(
+        secret=secret, command=network_pb2.Request.REGISTER, name=name)):
+      sock.sendto(data, server_addr)
+    socks.append(sock)
+    moves.append(encoder.Encode(network_pb2.Request(
+        secret=secret,
+        command=network_pb2.Request.MOVE,
+        direction=game_pb2.Coordinate(x=1, y=0)))[0])
+  time.sleep(0.1)
+  server._ReadClientRequests()
+  server._num_requests = 0
+
+  per_client = max(1, burst_size / num_clients)
+  read_seconds = 0.0
+  while server._num_requests < num_requests:
+    expected = server._num_requests + per_client * num_clients
+    for sock, data in zip(socks, moves):
+      for _ in xrange(per_client):
+        sock.sendto(data, server_addr)
+    deadline = time.time() + 1.0
+    while server._num_requests < expected and time.time() < deadline:
+      t = time.time()
+      server._ReadClientRequests()
+      read_seconds += time.time() - t
+  for sock in socks:
+    sock.close()
+  server._sock.Close()
+  return server._num_requests / read_seconds
+
+
+def BenchmarkCodec(width, height, num_ticks, repeat=5, seed=0):
+  """Prints encode and decode times and bytes for each way to send blocks.
+
+  Both a full update and the update from one tick are encoded, after a round
+  of AI play, with blocks as protos and packed by block_codec.
+  """
+  game = controller.Controller(
+      width, height, game_pb2.Mode.BATTLE, 0, seed=seed)
+  ai_rng = random.Random(seed)
+  ais_by_id = {}
+  for i in xrange(4):
+    secret = name = 'ai%d' % i
+    info = game_pb2.PlayerInfo(player_id=game.Register(secret, name), name=name)
+    ais_by_id[info.player_id] = ai_player.Player(secret, info, rng=ai_rng)
+  game.Action('ai0')
+  last_hash = None
+  delta = None
+  for _ in xrange(num_ticks):
+    game.Step()
+    last_hash, state = game.GetGameState(last_hash)
+    if state:
+      delta = state
+      for info in state.player_info:
+        if info.alive == game_pb2.PlayerInfo.ALIVE:
+          ais_by_id[info.player_id].UpdateAndDoCommands(state, game)
+  full = game.GetFullGameState()
+
+  sock = network._ProtoSocket(
+      socket.socket(socket.AF_INET, socket.SOCK_DGRAM), network_pb2.Response)
+  sender_addr = ('127.0.0.1', 0)
+  for kind, response in (('full', full), ('delta', delta)):
+    for packed in (False, True):
+      encode_seconds = decode_seconds = 0.0
+      for _ in xrange(repeat):
+        t = time.time()
+        datagrams = sock.Encode(response, packed)
+        encode_seconds += time.time() - t
+        t = time.time()
+        for data in datagrams:
+          sock._recv_buffer[:len(data)] = data
+          decoded = sock._Decode(len(data), sender_addr)
+        decode_seconds += time.time() - t
+        assert len(decoded.block_update) == len(response.block_update)
+      print (
+          '%4dx%-4d %-5s %-6s %6d blocks %8d bytes in %3d datagrams  '
+          'encode %7.2fms decode %7.2fms' % (
+              width, height, kind, 'packed' if packed else 'proto',
+              len(response.block_update), sum(len(d) for d in datagrams),
+              len(datagrams), 1000 * encode_seconds / repeat,
+              1000 * decode_seconds / repeat))
+
+
+def BenchmarkCompression(width, height, num_ticks, seed=0):
+  """Prints bytes and times to compress updates with zlib, and a dictionary.
+
+  The dictionary is trained on one game's updates and measured on another's.
+  """
+  for packed in (False, True):
+    training = train_dictionary.RecordResponses(
+        width, height, game_pb2.Mode.BATTLE, 4, num_ticks, seed, packed)
+    samples = train_dictionary.RecordResponses(
+        width, height, game_pb2.Mode.BATTLE, 4, num_ticks, seed + 1, packed)
+    t = time.time()
+    dictionary = compression.PresetDictionary(
+        compression.TrainDictionary(training))
+    train_seconds = time.time() - t
+    for name, d in (('zlib', None), ('dictionary', dictionary)):
+      t = time.time()
+      compressed = [compression.Compress(s, d) for s in samples]
+      compress_seconds = time.time() - t
+      t = time.time()
+      for c in compressed:
+        compression.Decompress(c, d)
+      decompress_seconds = time.time() - t
+      print (
+          '%4dx%-4d %-6s %-10s %5d updates %6.1f bytes each  compress '
+          '%6.1fus decompress %6.1fus' % (
+              width, height, 'packed' if packed else 'proto', name,
+              len(samples), float(sum(len(c) for c in compressed)) /
+              len(samples), 1e6 * compress_seconds / len(samples),
+              1e6 * decompress_seconds / len(samples)))
+    print '%4dx%-4d %-6s trained a %d byte dictionary in %.1fs' % (
+        width, height, 'packed' if packed else 'proto', len(dictionary.data),
+        train_seconds)
+
+
+def BenchmarkHeightMap(width, height, blur_size, seed=0):
+  """Prints time for each blur, and checks each makes the same seeded map."""
+  reference = None
+  for blur_fn in (
+      height_map._BoxBlurNaive,
+      height_map._BoxBlurSeparable,
+      height_map._BoxBlurNumpy if height_map.numpy else None):
+    if blur_fn is None:
+      continue
+    t = time.time()
+    grid = height_map.MakeHeightMap(
+        width, height, 0, 30, blur_size=blur_size, blur_fn=blur_fn,
+        rng=random.Random(seed))
+    dt = time.time() - t
+    reference = reference or grid
+    max_diff = max(
+        abs(a - b)
+        for ref_col, col in zip(reference, grid)
+        for a, b in zip(ref_col, col))
+    print '%4dx%-4d blur %d %-18s %6.3fs  max diff %g' % (
+        width, height, blur_size, blur_fn.__name__, dt, max_diff)
+    assert grid == reference, (
+        '%s made a different map from the same seed.' % blur_fn.__name__)
+
+
+if __name__ == '__main__':
+  common.ConfigureLogging()
+  summary_line, _, main_doc = __doc__.partition('\n\n')
+  parser = argparse.ArgumentParser(
+      description=summary_line,
+      epilog=main_doc,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument(
+      '--sizes', nargs='+', type=_ParseSize,
+      default=[(100, 30), (200, 50), (400, 200)],
+      help='World sizes to benchmark, as WIDTHxHEIGHT.')
+  parser.add_argument(
+      '--heads', type=int, default=4,
+      help='Number of moving player heads, for the world suite.')
+  parser.add_argument(
+      '--players', nargs='+', type=int, default=[2, 8],
+      help=(
+          'Numbers of AI players, for the controller suite, or of clients, '
+          'for the requests suite.'))
+  parser.add_argument(
+      '--modes', nargs='+', type=game_pb2.Mode.Id.Value,
+      default=game_pb2.Mode.Id.values(),
+      help='Game modes, for the controller suite: %s.' %
+           ', '.join(game_pb2.Mode.Id.keys()))
+  parser.add_argument(
+      '--rounds', nargs='+', type=int, default=[0, 10],
+      help='Starting round numbers, for the controller suite.')
+  parser.add_argument(
+      '--ticks', type=int, default=500,
+      help='Number of ticks to simulate for each configuration.')
+  parser.add_argument(
+      '--requests', type=int, default=20000,
+      help='Number of requests to read, for the requests suite.')
+  parser.add_argument(
+      '--seed', type=int, default=0,
+      help='Random seed for each controller suite game.')
+  parser.add_argument(
+      '-o', '--output',
+      help='File to write controller suite JSON to, instead of stdout.')
+  parser.add_argument(
+      '--suite',
+      choices=(
+          'controller', 'world', 'height_map', 'requests', 'codec',
+          'compression'),
+      default='controller',
+      help='Which benchmark to run.')
+  args = parser.parse_args()
+
+  if args.suite == 'controller':
+    results = []
+    for (width, height), num_players, mode, starting_round in (
+        itertools.product(args.sizes, args.players, args.modes, args.rounds)):
+      results.append(_RunWithPeakMemory(
+          BenchmarkController, width, height, num_players, mode,
+          starting_round, args.ticks, args.seed))
+      logging.info(
+          '%(width)dx%(height)d %(players)d players %(mode)s round '
+          '%(starting_round)d: %(ticks_per_sec).1f ticks/sec', results[-1])
+    out = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write('\n')
+  elif args.suite == 'requests':
+    for num_clients in args.players:
+      print '%3d clients %8.1f requests/sec' % (
+          num_clients, BenchmarkServerReads(num_clients, args.requests))
+
+  for width, height in args.sizes:
+    if args.suite == 'world':
+      full_scan_rate = BenchmarkWorldUpdates(
+          width, height, args.heads, args.ticks, full_scan=True)
+      rate = BenchmarkWorldUpdates(width, height, args.heads, args.ticks)
+      print '%4dx%-4d %8.1f ticks/sec, full scan %8.1f ticks/sec (%.1fx)' % (
+          width, height, rate, full_scan_rate, rate / full_scan_rate)
+    elif args.suite == 'height_map':
+      for blur_size in (1, 4):
+        BenchmarkHeightMap(width, height, blur_size)
+    elif args.suite == 'codec':
+      BenchmarkCodec(width, height, args.ticks)
+    elif args.suite == 'compression':
+      BenchmarkCompression(width, height, args.ticks)
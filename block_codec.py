@@ -0,0 +1,187 @@
+"""Packs Blocks into fixed-width records, a compact alternative to protos.
+
+Each block is a record of the same fields, stored column by column: all the
+flags, then all the types, all the x coordinates and so on. Tags and lengths
+are left out, and zlib finds long runs within each column, such as the x of
+terrain, which is listed column by column.
+
+Ticks and player IDs are packed as 32 bits, so ticks wrap after about two
+years of play at 60 ticks per second.
+
+Snapshots of a whole area, such as full updates, can instead list their plain
+terrain (blocks with no direction, tick or player) as runs of block types over
+every cell, column by column as the World stores them. Empty cells then cost
+next to nothing, and only the remaining blocks are packed one by one.
+"""
+
+import array
+import itertools
+import struct
+import sys
+
+from common import game_pb2
+
+
+_B = game_pb2.Block
+_COUNT = struct.Struct('<I')
+_RUNS_HEADER = struct.Struct('<II')  # first cell index, number of runs
+_MAX_RUN_LENGTH = 255  # Longer runs are split, to store lengths as bytes.
+# bits of the flags column, for which optional fields are set
+_HAS_DIRECTION = 1
+_HAS_LAST_VIABLE_TICK = 2
+_HAS_PLAYER_ID = 4
+# array typecodes of the columns: flags, type, x, y, direction x and y, last
+# viable tick and player ID
+_COLUMN_TYPES = ('B', 'B', 'H', 'H', 'b', 'b', 'I', 'I')
+assert [array.array(t).itemsize for t in _COLUMN_TYPES] == [
+    1, 1, 2, 2, 1, 1, 4, 4]
+
+
+def _ToString(column):
+  if sys.byteorder == 'big':
+    column.byteswap()
+  return column.tostring()
+
+
+def _FromString(typecode, data):
+  column = array.array(typecode)
+  column.fromstring(data)
+  if sys.byteorder == 'big':
+    column.byteswap()
+  return column
+
+
+def Pack(blocks):
+  """Returns a string of the blocks' records, for UnpackInto."""
+  columns = [array.array(typecode) for typecode in _COLUMN_TYPES]
+  (add_flags, add_type, add_x, add_y, add_dx, add_dy, add_tick,
+   add_player_id) = [column.append for column in columns]
+  count = 0
+  for block in blocks:
+    count += 1
+    flags = 0
+    add_type(block.type)
+    pos = block.pos
+    add_x(pos.x)
+    add_y(pos.y)
+    if block.HasField('direction'):
+      flags |= _HAS_DIRECTION
+      direction = block.direction
+      add_dx(direction.x)
+      add_dy(direction.y)
+    else:
+      add_dx(0)
+      add_dy(0)
+    if block.HasField('last_viable_tick'):
+      flags |= _HAS_LAST_VIABLE_TICK
+      add_tick(block.last_viable_tick)
+    else:
+      add_tick(0)
+    if block.HasField('player_id'):
+      flags |= _HAS_PLAYER_ID
+      add_player_id(block.player_id)
+    else:
+      add_player_id(0)
+    add_flags(flags)
+  return _COUNT.pack(count) + ''.join(_ToString(column) for column in columns)
+
+
+def UnpackInto(data, repeated_blocks):
+  """Adds the blocks packed in data to a repeated Block field."""
+  count, = _COUNT.unpack_from(data)
+  columns = []
+  offset = _COUNT.size
+  for typecode in _COLUMN_TYPES:
+    end = offset + array.array(typecode).itemsize * count
+    columns.append(_FromString(typecode, data[offset:end]))
+    offset = end
+  for flags, block_type, x, y, dx, dy, tick, player_id in itertools.izip(
+      *columns):
+    block = repeated_blocks.add(type=block_type)
+    block.pos.x = x
+    block.pos.y = y
+    if flags:
+      if flags & _HAS_DIRECTION:
+        block.direction.x = dx
+        block.direction.y = dy
+      if flags & _HAS_LAST_VIABLE_TICK:
+        block.last_viable_tick = tick
+      if flags & _HAS_PLAYER_ID:
+        block.player_id = player_id
+
+
+def PackTerrainRuns(blocks, width, height, x0=0, y0=0, runs_per_group=512):
+  """Splits a snapshot of an area into runs of terrain and other blocks.
+
+  Args:
+    blocks: All the blocks within the width x height area at (x0, y0).
+    runs_per_group: How many runs to pack in each string, so that a large
+        snapshot can still be split between datagrams.
+  Returns:
+    A list of strings for UnpackTerrainRunsInto, which together cover every
+    cell of the area, and a list of the blocks which are not plain terrain.
+  """
+  types_by_index = {}
+  others = []
+  for block in blocks:
+    if (block.type == _B.PLAYER_HEAD or block.HasField('direction') or
+        block.HasField('last_viable_tick') or block.HasField('player_id')):
+      others.append(block)
+    else:
+      types_by_index[
+          (block.pos.x - x0) * height + block.pos.y - y0] = block.type
+
+  # Runs are found from the terrain blocks, so this scales with the number of
+  # blocks rather than cells, with empty runs filling the gaps between them.
+  groups = []
+  start = 0
+  run_types = array.array('B')
+  run_lengths = array.array('B')
+  end = 0
+  for i, block_type in sorted(types_by_index.iteritems()) + [
+      (width * height, None)]:
+    for run_type, length in ((_B.EMPTY, i - end), (block_type, 1)):
+      if run_type is None:
+        continue
+      while length:
+        if (run_types and run_types[-1] == run_type and
+            run_lengths[-1] < _MAX_RUN_LENGTH):
+          n = min(length, _MAX_RUN_LENGTH - run_lengths[-1])
+          run_lengths[-1] += n
+          length -= n
+          continue
+        if len(run_types) == runs_per_group:
+          groups.append(_PackRuns(start, run_types, run_lengths))
+          start += sum(run_lengths)
+          run_types = array.array('B')
+          run_lengths = array.array('B')
+        n = min(length, _MAX_RUN_LENGTH)
+        run_types.append(run_type)
+        run_lengths.append(n)
+        length -= n
+    end = i + 1
+  if run_types:
+    groups.append(_PackRuns(start, run_types, run_lengths))
+  return groups, others
+
+
+def _PackRuns(start, run_types, run_lengths):
+  return (
+      _RUNS_HEADER.pack(start, len(run_types)) +
+      run_types.tostring() + run_lengths.tostring())
+
+
+def UnpackTerrainRunsInto(data, height, x0, y0, repeated_blocks):
+  """Adds the non-empty terrain in one of PackTerrainRuns' strings."""
+  start, count = _RUNS_HEADER.unpack_from(data)
+  offset = _RUNS_HEADER.size
+  run_types = array.array('B', data[offset:offset + count])
+  run_lengths = array.array('B', data[offset + count:])
+  i = start
+  for block_type, length in itertools.izip(run_types, run_lengths):
+    if block_type != _B.EMPTY:
+      for j in xrange(i, i + length):
+        block = repeated_blocks.add(type=block_type)
+        block.pos.x = x0 + j / height
+        block.pos.y = y0 + j % height
+    i += length
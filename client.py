@@ -15,6 +15,7 @@ import controller
 import network
 
 
+_B = game_pb2.Block
 _MAX_LOCAL_PLAYERS = len(client_config.MOVE_KEYS)
 assert _MAX_LOCAL_PLAYERS == len(client_config.ACTION_KEYS)
 
@@ -34,6 +35,13 @@ class Client(object):
     self._prev_size = (None, None)
 
     self._game_state = None
+    # Blocks known to be in the world, which may be only those in a view.
+    self._blocks_by_pos = {}
+    self._updated_positions = set()
+    self._repaint_all = True
+    # The part of the world shown, which scrolls to follow the first player.
+    self._view_origin = None
+    self._view_size = None
 
   def Register(self, name, ai=False):
     secret = str(random.random())
@@ -72,7 +80,8 @@ class Client(object):
       current_size = self._window.getmaxyx()
       if current_size != self._prev_size:
         self._prev_size = current_size
-        # TODO self._game_server.RequestFullUpdate()
+        self._game_server.RequestFullUpdate(self._GetViewSizeToRequest())
+        self._repaint_all = True
       updated = self._UpdateGameState()
       if updated or (
           self._game_state and
@@ -106,36 +115,68 @@ class Client(object):
     if key_code == client_config.ACTION_KEYS[i]:
       self._game_server.Action(secret)
 
+  def _GetViewSizeToRequest(self):
+    """Returns the window's size for the world, to only be sent that much.
+
+    AIs look around their own heads, so with AIs everything is requested.
+    """
+    if self._ai_players_by_id:
+      return None
+    h, w = self._window.getmaxyx()
+    return game_pb2.Coordinate(
+        x=max(0, w - 1), y=max(0, h - self._num_message_lines))
+
   def _UpdateGameState(self):
     states = self._game_server.GetUpdates()
     if not states:
       return False
+    for state in states:
+      self._ApplyBlockUpdates(state)
     self._game_state = states[-1]
     if len(states) > 1:
       logging.info('got %d states at once, squashing', len(states))
       block_updates = []
+      full_update = False
       for state in states:
+        if state.full_update:
+          block_updates = []
+          full_update = True
         block_updates += state.block_update
       del self._game_state.block_update[:]
       self._game_state.block_update.extend(block_updates)
+      self._game_state.full_update = full_update
     self._player_info_by_id = dict(
         (info.player_id, info) for info in self._game_state.player_info)
     return True
 
+  def _ApplyBlockUpdates(self, state):
+    if state.full_update:
+      self._blocks_by_pos.clear()
+      self._repaint_all = True
+    if state.HasField('view_origin'):
+      # Forget blocks out of view, which the server stops updating.
+      x0, y0 = state.view_origin.x, state.view_origin.y
+      x1, y1 = x0 + state.view_size.x, y0 + state.view_size.y
+      for x, y in self._blocks_by_pos.keys():
+        if not (x0 <= x < x1 and y0 <= y < y1):
+          del self._blocks_by_pos[(x, y)]
+    for block in state.block_update:
+      pos = (block.pos.x, block.pos.y)
+      if block.type == _B.EMPTY:
+        self._blocks_by_pos.pop(pos, None)
+      else:
+        self._blocks_by_pos[pos] = block
+      self._updated_positions.add(pos)
+
   def _CheckWindowSize(self):
     h, w = self._window.getmaxyx()
-    if (self._game_state and
-        self._game_state.size.x < w and
-        self._game_state.size.y + self._num_message_lines <= h):
+    if self._game_state and w > 1 and h > self._num_message_lines:
       return True
 
     if self._game_state:
       message = (
-          'Resize to %dx%d (now %dx%d).' %
-          (self._game_state.size.x + 1,
-           self._game_state.size.y + self._num_message_lines,
-           w,
-           h))
+          'Resize to at least 2x%d (now %dx%d).' %
+          (self._num_message_lines + 1, w, h))
     else:
       message = 'Waiting for initial server data...'
 
@@ -144,13 +185,41 @@ class Client(object):
 
     return False
 
+  def _ScrollView(self, h, w):
+    """Moves the view to where the server's is, or else to follow a player."""
+    size = self._game_state.size
+    view_size = game_pb2.Coordinate(
+        x=min(w - 1, size.x), y=min(h - self._num_message_lines, size.y))
+    if self._game_state.HasField('view_origin'):
+      origin = self._game_state.view_origin
+    else:
+      followed_pos = None
+      for block in self._game_state.block_update:
+        if (block.type == _B.PLAYER_HEAD and
+            block.player_id in self._local_player_ids_ordered[:1]):
+          followed_pos = block.pos
+      origin = common.ScrollView(
+          self._view_origin, view_size, size, followed_pos)
+    if origin != self._view_origin or view_size != self._view_size:
+      self._view_origin = game_pb2.Coordinate(x=origin.x, y=origin.y)
+      self._view_size = view_size
+      self._repaint_all = True
+
   def _Repaint(self):
     h, w = self._window.getmaxyx()
 
-    if self._game_state.full_update:
+    self._ScrollView(h, w)
+    if self._repaint_all:
       self._window.erase()
-    for block in self._game_state.block_update:
-      self._RenderBlock(block)
+      for block in self._blocks_by_pos.itervalues():
+        self._RenderBlock(block)
+    else:
+      for x, y in self._updated_positions:
+        block = self._blocks_by_pos.get((x, y))
+        self._RenderBlock(block or _B(
+            type=_B.EMPTY, pos=game_pb2.Coordinate(x=x, y=y)))
+    self._repaint_all = False
+    self._updated_positions.clear()
 
     for i, player_id in enumerate(self._local_player_ids_ordered, 1):
       self._RenderSummaryLine(i, player_id, h, w)
@@ -183,7 +252,7 @@ class Client(object):
       message = '%s %s' % (u'\u2665' * self._game_state.lives, message)
     self._window.move(h - 1, 1)
     self._window.clrtoeol()
-    self._window.addstr(message.encode('utf-8'))
+    self._window.addstr(message[:w - 2].encode('utf-8'))
 
   def _RenderSummaryLine(self, local_player_cardinal, player_id, h, w):
     info = self._player_info_by_id[player_id]
@@ -208,6 +277,10 @@ class Client(object):
       self._window.addstr('  ' + inventory.encode('utf-8'), palette_attr)
 
   def _RenderBlock(self, block):
+    x = block.pos.x - self._view_origin.x
+    y = block.pos.y - self._view_origin.y
+    if not (0 <= x < self._view_size.x and 0 <= y < self._view_size.y):
+      return
     s = '?'
     name = None
     s_attr = curses.A_NORMAL
@@ -232,12 +305,13 @@ class Client(object):
     else:
       s = client_config.BLOCK_CHARACTERS.get(
           block.type, client_config.DEFAULT_BLOCK_CHARACTER)
-    self._window.addstr(block.pos.y, block.pos.x, s.encode('utf-8'), s_attr)
+    self._window.addstr(y, x, s.encode('utf-8'), s_attr)
     if name is not None:
-      name_x = block.pos.x + 2
-      if name_x + len(name) >= self._game_state.size.x:
-        name_x = block.pos.x - (2 + len(name))
-      self._window.addstr(block.pos.y, name_x, name, s_attr)
+      name_x = x + 2
+      if name_x + len(name) >= self._view_size.x:
+        name_x = x - (2 + len(name))
+      if name_x >= 0:
+        self._window.addstr(y, name_x, name, s_attr)
 
 
 def _PrintBlockSummary():
@@ -254,8 +328,8 @@ def _PrintBlockSummary():
            description))
 
 
-def RunClient(host, ai_names, server=None):
-  game_server = server or network.Client(host, network.PORT)
+def RunClient(host, ai_names, server=None, room_id=''):
+  game_server = server or network.Client(host, network.PORT, room_id)
 
   locale.setlocale(locale.LC_ALL, '')
 
@@ -9,6 +9,36 @@ def MakeGrid(size):
   return grid
 
 
+def ScrollView(origin, view_size, world_size, focus):
+  """Returns where a view should start to keep focus in its middle half.
+
+  The view only moves once focus leaves the middle, and then centers on it, so
+  that it scrolls in occasional jumps rather than at every step. It stays
+  within the world.
+
+  Args:
+    origin: The view's current origin Coordinate, or None to center on focus.
+    view_size: Coordinate, the size of the view.
+    world_size: Coordinate.
+    focus: Coordinate to keep in view, or None to stay put.
+  """
+  new_origin = []
+  for axis in ('x', 'y'):
+    view_len = getattr(view_size, axis)
+    start = getattr(origin, axis) if origin else None
+    if focus:
+      pos = getattr(focus, axis)
+      margin = view_len / 4
+      if (start is None or
+          pos < start + margin or pos >= start + view_len - margin):
+        start = pos - view_len / 2
+    elif start is None:
+      start = (getattr(world_size, axis) - view_len) / 2
+    new_origin.append(
+        max(0, min(start, getattr(world_size, axis) - view_len)))
+  return game_pb2.Coordinate(x=new_origin[0], y=new_origin[1])
+
+
 def ConfigureLogging(**kwargs):
   logging.basicConfig(
       format='%(levelname)s %(asctime)s %(filename)s:%(lineno)s: %(message)s',
@@ -27,3 +57,4 @@ from google.protobuf import message
 import ai_player_pb2  # protoc --python_out=. *.proto
 import game_pb2
 import network_pb2
+import replay_pb2
@@ -0,0 +1,135 @@
+"""zlib compression with a preset dictionary of bytes common to messages.
+
+Most updates are small, so zlib has little within each one to learn from, while
+every update repeats the same field tags, player names, block types and so on.
+A preset dictionary primes the compressor's window with such bytes, which each
+message can then refer back to.
+
+Messages compressed with a dictionary are standard zlib streams with the FDICT
+flag and the dictionary's Adler-32 checksum in their header (RFC 1950). Python
+2's zlib can't set a dictionary directly, so a compressor and decompressor are
+primed by passing the dictionary through them once, and each message uses a
+copy of the primed state.
+
+Streaming contexts shared between messages would compress better still, but
+need every datagram to arrive, in order, which UDP doesn't promise.
+"""
+
+import collections
+import heapq
+import struct
+import zlib
+
+
+_FDICT = 0x20  # flag in the second byte of a zlib header
+_DICT_HEADER = struct.Struct('!BBI')  # CMF, FLG, dictionary ID
+_ADLER32 = struct.Struct('!I')
+
+
+def _Adler32(data):
+  return zlib.adler32(data) & 0xffffffff
+
+
+class PresetDictionary(object):
+  """Compresses and decompresses messages with a preset dictionary."""
+  def __init__(self, data, level=zlib.Z_DEFAULT_COMPRESSION):
+    """Primes zlib with the dictionary data, at most 32KB."""
+    self.data = data
+    self.dict_id = _Adler32(data)
+    self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    primer = (
+        self._compressor.compress(data) +
+        self._compressor.flush(zlib.Z_SYNC_FLUSH))
+    self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    self._decompressor.decompress(primer)
+    cmf = zlib.DEFLATED | (zlib.MAX_WBITS - 8) << 4
+    flg = 2 << 6 | _FDICT  # default compression level
+    flg += 31 - (cmf << 8 | flg) % 31
+    self._header = _DICT_HEADER.pack(cmf, flg, self.dict_id)
+
+  def Compress(self, data):
+    compressor = self._compressor.copy()
+    return ''.join((
+        self._header,
+        compressor.compress(data),
+        compressor.flush(),
+        _ADLER32.pack(_Adler32(data))))
+
+  def Decompress(self, data):
+    """Returns the data of a message from Compress, or raises zlib.error."""
+    _, _, dict_id = _DICT_HEADER.unpack_from(data)
+    if dict_id != self.dict_id:
+      raise zlib.error('Dictionary ID %08x is not %08x.' % (
+          dict_id, self.dict_id))
+    decompressor = self._decompressor.copy()
+    result = decompressor.decompress(
+        data[_DICT_HEADER.size:len(data) - _ADLER32.size])
+    checksum, = _ADLER32.unpack_from(data, len(data) - _ADLER32.size)
+    if checksum != _Adler32(result):
+      raise zlib.error('Incorrect data check.')
+    return result
+
+
+def Load(path):
+  """Returns the PresetDictionary saved in a file, as by train_dictionary.py."""
+  with open(path, 'rb') as f:
+    return PresetDictionary(f.read())
+
+
+def Compress(data, dictionary=None):
+  """Compresses data with zlib, using a PresetDictionary if given."""
+  if dictionary:
+    return dictionary.Compress(data)
+  return zlib.compress(data)
+
+
+def Decompress(data, dictionary=None):
+  """Decompresses a message from Compress, with or without a dictionary."""
+  if len(data) > 1 and ord(data[1]) & _FDICT:
+    if not dictionary:
+      raise zlib.error('Need a dictionary.')
+    return dictionary.Decompress(data)
+  return zlib.decompress(data)
+
+
+def TrainDictionary(samples, size=16384, gram_length=8, segment_length=32):
+  """Returns dictionary data of substrings common to many of the samples.
+
+  Segments of the samples are chosen greedily, each for the most gram_length
+  substrings it contains which appear in the most samples and which no chosen
+  segment has yet. The most useful come last, nearest to the messages.
+  """
+  counts = collections.Counter()
+  segments = set()
+  for sample in samples:
+    counts.update(set(
+        sample[i:i + gram_length]
+        for i in xrange(len(sample) - gram_length + 1)))
+    for i in xrange(0, max(1, len(sample) - segment_length + 1),
+                    segment_length / 2):
+      segments.add(sample[i:i + segment_length])
+
+  def Score(segment):
+    return sum(
+        counts[gram] for gram in set(
+            segment[i:i + gram_length]
+            for i in xrange(len(segment) - gram_length + 1)))
+
+  # A heap of segments by their (possibly stale, only ever too high) scores.
+  heap = [(-Score(segment), segment) for segment in segments]
+  heapq.heapify(heap)
+  chosen = []
+  total_size = 0
+  while heap and total_size < size:
+    _, segment = heapq.heappop(heap)
+    score = Score(segment)
+    if heap and score < -heap[0][0]:
+      heapq.heappush(heap, (-score, segment))
+      continue
+    if score <= len(segment) - gram_length + 1:
+      break  # Nothing left is in more than one sample.
+    chosen.append(segment)
+    total_size += len(segment)
+    for i in xrange(len(segment) - gram_length + 1):
+      counts[segment[i:i + gram_length]] = 0
+  return ''.join(reversed(chosen))[-size:]
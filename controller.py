@@ -1,16 +1,15 @@
 """Controller of game state and client interaction; the central game logic."""
 
 import argparse
-import collections
-import itertools
 import logging
 import random
 import time
 
 from common import game_pb2, network_pb2
-import common
 import config
+import profiling
 import scoring
+import terrain_pool
 import world
 
 
@@ -22,6 +21,9 @@ _ROCKETS_PER_AMMO = 3
 _HEAD_MOVE_INTERVAL = 3  # This makes rockets faster than player snakes.
 
 _NUKE_SIZE = 5
+# Most ticks to run at once when behind schedule. Beyond this the game slows
+# down, rather than the server stalling on simulation.
+_MAX_CATCH_UP_TICKS = 4
 
 _B = game_pb2.Block
 _POWER_UPS = [
@@ -33,11 +35,38 @@ _POWER_UPS = [
 
 
 class Controller(object):
-  def __init__(self, width, height, mode, starting_round=0):
-    self._world = world.World(width, height)
+  def __init__(
+      self, width, height, mode, starting_round=0, terrain_pool_size=0,
+      phase_timer=profiling.NULL_TIMER, seed=None, clock=time.time):
+    """Starts a game, collecting players for its first round.
+
+    Args:
+      seed: If given, all of the game's randomness comes from a random.Random
+          with this seed rather than the random module, so that the same
+          requests on the same ticks always play out the same way. There is
+          no terrain pool then, since it draws in another process.
+      clock: A function returning the time in seconds, which Update runs ticks
+          on the schedule of. Deterministic runs may instead call Step.
+    """
+    self._phase_timer = phase_timer
+    self._rng = random if seed is None else random.Random(seed)
+    self._clock = clock
+    self._terrain_pool = None
+    if terrain_pool_size > 0:
+      if seed is None:
+        self._terrain_pool = terrain_pool.TerrainPool(
+            world.ClampSize(width), world.ClampSize(height), terrain_pool_size)
+      else:
+        logging.info('Not using a terrain pool, for a seeded game.')
+    self._world = world.World(
+        width, height, terrain_pool=self._terrain_pool, rng=self._rng)
 
     self._next_player_id = 0
     self._player_infos_by_secret = {}
+    # Indexes of the above, maintained in Register and Unregister.
+    self._player_infos_by_id = {}
+    self._player_secrets_by_id = {}
+    self._player_names = set()
 
     self._scoring = {
         game_pb2.Mode.BATTLE: scoring.Battle,
@@ -46,9 +75,11 @@ class Controller(object):
 
     self._dirty = True
     self._state_hash = 0
+    self._full_state_hash = None
     self._stage = None
     self._start_requested = False
-    self._last_update = time.time()
+    self._last_update = clock()
+    self.num_skipped_ticks = 0
     self._tick = 0
     self._starting_round = max(0, int(starting_round))
     self._round_num = self._starting_round
@@ -96,11 +127,12 @@ class Controller(object):
       self._SetSpeeds()
 
       if self._round_num in (2, 4) or self._round_num >= 6:
-        power_up_type = random.choice(_POWER_UPS + [_B.NUKE])
+        power_up_type = self._rng.choice(_POWER_UPS + [_B.NUKE])
       else:
         power_up_type = None
       self._world.RemoveAllPlayerHeads()
-      self._world.ClearBlocksAndRebuildTerrain(power_up_type)
+      with self._phase_timer.Phase('terrain'):
+        self._world.ClearBlocksAndRebuildTerrain(power_up_type)
       for secret, info in self._player_infos_by_secret.iteritems():
         self._AddPlayerHeadResetPos(secret, info)
         info.alive = game_pb2.PlayerInfo.ALIVE
@@ -113,26 +145,81 @@ class Controller(object):
   def GetGameState(self, last_hash):
     collecting = self._stage == game_pb2.Stage.COLLECT_PLAYERS
     if self._dirty or (self._world.dirty and not collecting):
-      if collecting:
-        blocks = list(self._world.IterAllPlayerHeads())
-      else:
-        blocks = list(self._world.GenerateAndClearUpdates())
-      self._client_facing_state = network_pb2.Response(
-          tick=self._tick,
-          size=self._world.size,
-          player_info=self._player_infos_by_secret.values(),
-          block_update=blocks,
-          full_update=collecting,
-          stage=self._stage,
-          round_num=self._round_num)
-      if self._scoring.lives is not None:
-        self._client_facing_state.lives = max(0, self._scoring.lives)
-      self._dirty = False
-      self._state_hash += 1
+      with self._phase_timer.Phase('state'):
+        self._GenerateGameState(collecting)
 
     return (self._state_hash, None) if last_hash == self._state_hash else (
         self._state_hash, self._client_facing_state)
 
+  def GetFullGameState(self):
+    """Returns a full update matching the state last returned by GetGameState.
+
+    This is for clients which missed updates, so it is only regenerated when
+    the game state has changed.
+    """
+    if self._full_state_hash != self._state_hash:
+      if self._client_facing_state.full_update:
+        self._full_state = self._client_facing_state
+      else:
+        self._full_state = self._MakeResponse(
+            self._client_facing_state.tick,
+            self._world.IterAllBlocks(),
+            full_update=True)
+      self._full_state_hash = self._state_hash
+    return self._full_state
+
+  def GetBlocksInRect(self, x0, y0, x1, y1):
+    """Returns the blocks a full update would have, with x0 <= x < x1 etc."""
+    if self._stage == game_pb2.Stage.COLLECT_PLAYERS:
+      return [
+          head for head in self._world.IterAllPlayerHeads()
+          if x0 <= head.pos.x < x1 and y0 <= head.pos.y < y1]
+    return list(self._world.IterBlocksInRect(x0, y0, x1, y1))
+
+  def GetPlayerPos(self, secret):
+    """Returns where a player's head is, or None if they have none now."""
+    head = self._world.GetPlayerHead(secret)
+    return head.pos if head else None
+
+  def GetPlayerId(self, secret):
+    """Returns the ID a secret is registered as, or None."""
+    info = self._player_infos_by_secret.get(secret)
+    return info.player_id if info else None
+
+  @property
+  def tick(self):
+    return self._tick
+
+  @property
+  def round_num(self):
+    return self._round_num
+
+  def _GenerateGameState(self, collecting):
+    if collecting:
+      blocks = self._world.IterAllPlayerHeads()
+      full_update = True
+    else:
+      # A new round's first update replaces all the blocks of the last.
+      full_update = self._world.all_updated
+      blocks = self._world.GenerateAndClearUpdates()
+    self._client_facing_state = self._MakeResponse(
+        self._tick, blocks, full_update=full_update)
+    self._dirty = False
+    self._state_hash += 1
+
+  def _MakeResponse(self, tick, blocks, full_update):
+    response = network_pb2.Response(
+        tick=tick,
+        size=self._world.size,
+        player_info=self._player_infos_by_secret.values(),
+        block_update=list(blocks),
+        full_update=full_update,
+        stage=self._stage,
+        round_num=self._round_num)
+    if self._scoring.lives is not None:
+      response.lives = max(0, self._scoring.lives)
+    return response
+
   def Register(self, secret, name):
     if secret in self._player_infos_by_secret:
       raise RuntimeError(
@@ -141,8 +228,7 @@ class Controller(object):
               self._player_infos_by_secret[secret]))
     if not name:
       raise RuntimeError('Player name %r not allowed!' % name)
-    if name in [
-        info.name for info in self._player_infos_by_secret.values()]:
+    if name in self._player_names:
       raise RuntimeError('Player name %s is already taken.' % name)
 
     starting_alive = (
@@ -155,6 +241,9 @@ class Controller(object):
         alive=starting_alive)
     self._scoring.AddPlayer(info)
     self._player_infos_by_secret[secret] = info
+    self._player_infos_by_id[info.player_id] = info
+    self._player_secrets_by_id[info.player_id] = secret
+    self._player_names.add(name)
     self._dirty = True
     self._next_player_id += 1
     if self._stage == game_pb2.Stage.COLLECT_PLAYERS:
@@ -179,7 +268,11 @@ class Controller(object):
       self._world.SetPlayerHead(player_secret, head)
 
   def Unregister(self, secret):
-    self._player_infos_by_secret.pop(secret, None)
+    info = self._player_infos_by_secret.pop(secret, None)
+    if info:
+      del self._player_infos_by_id[info.player_id]
+      del self._player_secrets_by_id[info.player_id]
+      self._player_names.remove(info.name)
     head = self._world.RemovePlayerHead(secret)
     if head:
       self._scoring.RemovePlayer(head.player_id)
@@ -247,43 +340,60 @@ class Controller(object):
                 secret, self._world.GetRandomPosClearOfTerrain())
 
   def _AddRocket(self, origin, direction, player_id, initial_advance=False):
+    x, y = origin.x, origin.y
     if initial_advance:
-      rocket_pos = game_pb2.Coordinate(
-          x=(origin.x + direction.x) % self._world.size.x,
-          y=(origin.y + direction.y) % self._world.size.y)
-    else:
-      rocket_pos = origin
-    self._world.AddRocket(_B(
-        type=_B.ROCKET,
-        pos=rocket_pos,
-        direction=direction,
-        last_viable_tick=self._tick + _ROCKET_DURATION_TICKS,
-        player_id=player_id))
+      x = (x + direction.x) % self._world.size.x
+      y = (y + direction.y) % self._world.size.y
+    self._world.AddRocket(
+        x, y, direction.x, direction.y, player_id,
+        self._tick + _ROCKET_DURATION_TICKS)
 
   def _AddNuke(self, origin, direction, player_id):
     for i in xrange(-_NUKE_SIZE, _NUKE_SIZE + 1):
       for j in xrange(-_NUKE_SIZE, _NUKE_SIZE + 1):
         if (i, j) == (0, 0) or abs(i) + abs(j) > 1.7 * _NUKE_SIZE:
           continue
-        pos = game_pb2.Coordinate(
-            x=(origin.x + i) % self._world.size.x,
-            y=(origin.y + j) % self._world.size.y)
-        self._world.AddRocket(_B(
-            type=_B.ROCKET,
-            pos=pos,
-            direction=game_pb2.Coordinate(
-                x=(-1 if i < 0 else 1) if abs(i) >= abs(j) else 0,
-                y=(-1 if j < 0 else 1) if abs(j) >= abs(i) else 0),
-            last_viable_tick=self._tick + _ROCKET_DURATION_TICKS,
-            player_id=player_id))
+        self._world.AddRocket(
+            (origin.x + i) % self._world.size.x,
+            (origin.y + j) % self._world.size.y,
+            (-1 if i < 0 else 1) if abs(i) >= abs(j) else 0,
+            (-1 if j < 0 else 1) if abs(j) >= abs(i) else 0,
+            player_id,
+            self._tick + _ROCKET_DURATION_TICKS)
+
+  def HasPlayers(self):
+    return bool(self._player_infos_by_secret)
+
+  def Close(self):
+    """Stops any background terrain generation."""
+    if self._terrain_pool:
+      self._terrain_pool.Close()
+
+  def GetNextUpdateTime(self):
+    """Returns the clock time at which Update will next advance the game."""
+    return self._last_update + self._update_interval
 
   def Update(self):
-    t = time.time()
-    dt = t - self._last_update
-    if dt < self._update_interval:
-      return False
-    self._last_update = t
+    """Runs any ticks due by now on a fixed schedule.
+
+    Returns:
+      The number of ticks run.
+    """
+    t = self._clock()
+    num_ticks = 0
+    while t >= self._last_update + self._update_interval:
+      if num_ticks == _MAX_CATCH_UP_TICKS:
+        self.num_skipped_ticks += int(
+            (t - self._last_update) / self._update_interval)
+        self._last_update = t
+        break
+      self._last_update += self._update_interval
+      self.Step()
+      num_ticks += 1
+    return num_ticks
 
+  def Step(self):
+    """Advances the game by one tick, regardless of the update interval."""
     if self._stage == game_pb2.Stage.COLLECT_PLAYERS:
       if self._start_requested:
         self._SetStage(game_pb2.Stage.ROUND)
@@ -296,13 +406,45 @@ class Controller(object):
       self._SetPlayerStartTicks()
     self._tick += 1
     self._pause_ticks += 1
-    return True
 
   def _SetPlayerStartTicks(self):
     for info in self._player_infos_by_secret.itervalues():
       info.first_active_tick = self._tick + self._pause_duration_ticks
 
   def _Tick(self):
+    with self._phase_timer.Phase('movement'):
+      self._MoveHeads()
+    with self._phase_timer.Phase('expiry'):
+      self._world.ExpireBlocks(self._tick)
+    with self._phase_timer.Phase('movement'):
+      self._world.AdvanceRockets()
+    with self._phase_timer.Phase('expiry'):
+      self._ExpirePowerUps()
+
+    old_positions = {
+        head.player_id: head.pos for head in self._world.IterAllPlayerHeads()}
+    with self._phase_timer.Phase('collisions'):
+      self._ProcessCollisions()
+    with self._phase_timer.Phase('scoring'):
+      for secret, info in self._player_infos_by_secret.iteritems():
+        if info.alive == game_pb2.PlayerInfo.DEAD:
+          if self._scoring.UseRespawn():
+            self._AddPlayerHeadResetPos(secret, info)
+            info.alive = game_pb2.PlayerInfo.ALIVE
+          else:
+            self._AddPlayerHeadResetPos(
+                secret, info, as_mine_at=old_positions[info.player_id])
+            info.alive = game_pb2.PlayerInfo.ZOMBIE
+          info.first_active_tick = self._tick + self._pause_duration_ticks
+
+      if self._scoring.IsGameOver():
+        self._SetStage(game_pb2.Stage.GAME_OVER)
+      elif self._scoring.IsRoundEnd():
+        self._SetStage(game_pb2.Stage.ROUND_END)
+
+    self._dirty = True
+
+  def _MoveHeads(self):
     tail_duration = _HEAD_MOVE_INTERVAL * (
         _STARTING_TAIL_LENGTH + self._tick / _TAIL_GROWTH_TICKS)
     for secret, info in self._player_infos_by_secret.iteritems():
@@ -325,11 +467,8 @@ class Controller(object):
               player_id=head.player_id)
           self._world.SetTerrain(tail)
 
-    self._world.ExpireBlocks(self._tick)
-    for rocket in self._world.IterAllRockets():
-      self._world.AdvanceBlock(rocket)
-
-    # Expire the oldest power-up and activate the next one in the queue.
+  def _ExpirePowerUps(self):
+    """Expires the oldest power-up and activates the next one in the queue."""
     for info in self._player_infos_by_secret.itervalues():
       if info.power_up:
         if info.power_up[0].last_viable_tick < self._tick:
@@ -339,50 +478,29 @@ class Controller(object):
             remaining[0].last_viable_tick = self._tick + self._power_up_duration
             info.power_up.extend(remaining)
 
-    old_positions = {
-        head.player_id: head.pos for head in self._world.IterAllPlayerHeads()}
-    self._ProcessCollisions()
-    for secret, info in self._player_infos_by_secret.iteritems():
-      if info.alive == game_pb2.PlayerInfo.DEAD:
-        if self._scoring.UseRespawn():
-          self._AddPlayerHeadResetPos(secret, info)
-          info.alive = game_pb2.PlayerInfo.ALIVE
-        else:
-          self._AddPlayerHeadResetPos(
-              secret, info, as_mine_at=old_positions[info.player_id])
-          info.alive = game_pb2.PlayerInfo.ZOMBIE
-        info.first_active_tick = self._tick + self._pause_duration_ticks
-
-    if self._scoring.IsGameOver():
-      self._SetStage(game_pb2.Stage.GAME_OVER)
-    elif self._scoring.IsRoundEnd():
-      self._SetStage(game_pb2.Stage.ROUND_END)
-
-    self._dirty = True
-
   def _ProcessCollisions(self):
     destroyed = []
-    moving_blocks_grid = common.MakeGrid(self._world.size)
+    # Moving blocks which were first into a shared cell this tick.
+    moving_blocks_by_pos = {}
     active_heads = filter(
         bool,  # Filter when some are killed but others are still playing.
         (self._world.GetPlayerHead(secret)
          for secret, info in self._player_infos_by_secret.iteritems()
          if self._tick >= info.first_active_tick))
-    for b in itertools.chain(active_heads, self._world.IterAllRockets()):
-      hit = None
-      for target_grid in (moving_blocks_grid, self._world):
-        if hasattr(target_grid, 'GetTerrain'):
-          # TODO Store heads and rockets in world, generic Get.
-          hit = target_grid.GetTerrain(b.pos)
-        else:
-          hit = target_grid[b.pos.x][b.pos.y]
+    # Rockets are identified by rocket_index (None for heads) to destroy them.
+    for b, rocket_index in self._world.IterCrowdedMovingBlocks(active_heads):
+      pos = (b.pos.x, b.pos.y)
+      terrain = self._world.GetTerrain(b.pos)
+      for hit, hit_rocket_index in (
+          moving_blocks_by_pos.get(pos, (None, None)),
+          (terrain, None)):
         if hit:
-          destroyed.append((hit, b))
+          destroyed.append((hit, hit_rocket_index, b))
           if not self._CheckIsPlayerHeadPickUpItem(b, hit):
-            destroyed.append((b, hit))
-      if not hit:
-        moving_blocks_grid[b.pos.x][b.pos.y] = b
-    for b, hit_by in destroyed:
+            destroyed.append((b, rocket_index, hit))
+      if not terrain:
+        moving_blocks_by_pos[pos] = (b, rocket_index)
+    for b, rocket_index, hit_by in destroyed:
       escaped = False
       if b.type in (_B.PLAYER_HEAD, _B.MINE) and b.HasField('player_id'):
         escaped = not self._KillPlayer(b.player_id)
@@ -390,13 +508,10 @@ class Controller(object):
           self._ExplodeAsMine(b)
       elif b.type == _B.ROCKET:
         # Mark for immediate expiration rather than finding/deleting now.
-        b.last_viable_tick = self._tick - 1
-      elif self._world.GetTerrain(b.pos) is b:  # Terrain was hit.
+        self._world.KillRocket(rocket_index)
+      elif self._world.GetTerrain(b.pos) == b:  # Terrain was hit.
         self._world.ClearTerrain(b.pos)
-        if b.type == _B.PLAYER_TAIL:
-          # Flag for deletion rather than finding and deleting now.
-          b.last_viable_tick = self._tick - 1
-        elif b.type == _B.ROCK:
+        if b.type == _B.ROCK:
           self._world.SetTerrain(_B(type=_B.BROKEN_ROCK, pos=b.pos))
         elif b.type == _B.MINE or (
             b.type == _B.NUKE and hit_by.type == _B.ROCKET):
@@ -416,10 +531,7 @@ class Controller(object):
   def _CheckIsPlayerHeadPickUpItem(self, head, block):
     if not head.type == _B.PLAYER_HEAD:
       return False
-    for player in self._player_infos_by_secret.values():
-      if head.player_id == player.player_id:
-        info = player
-        break
+    info = self._player_infos_by_id.get(head.player_id)
     if not info:
       return False
     if block.type == _B.AMMO:
@@ -430,37 +542,28 @@ class Controller(object):
       return False
     return True
 
-  def _GetSecretForPlayerId(self, player_id):
-    for secret, info in self._player_infos_by_secret.iteritems():
-      if info.player_id == player_id:
-        return secret
-    return None
-
   def _KillPlayer(self, player_id, force=False):
     """Removes a player's head from the world and updates their alive state.
 
     Returns:
       True if the player died, False if something prevented killing them.
     """
-    secret = self._GetSecretForPlayerId(player_id)
+    secret = self._player_secrets_by_id.get(player_id)
+    info = self._player_infos_by_id.get(player_id)
     if secret:
       if not force:
-        info = self._player_infos_by_secret[secret]
         if (info.power_up and info.power_up[0].type == _B.INVINCIBLE or
             info.first_active_tick > self._tick):
           return False
       self._world.RemovePlayerHead(secret)
     # Tail blocks will no longer update, but are already in statics.
-    self._world.StopTerrainExpiration(
-        lambda block: block.type == _B.PLAYER_TAIL
-        and block.player_id == player_id)
-    for other_secret, info in self._player_infos_by_secret.iteritems():
-      if secret == other_secret:
-        # If this is after Unregister, there may be no PlayerInfo for the
-        # player being killed.
-        info.alive = (
-            game_pb2.PlayerInfo.DEAD if info.alive == game_pb2.PlayerInfo.ALIVE
-            else game_pb2.PlayerInfo.ZOMBIE_DEAD)
+    self._world.StopTerrainExpiration(player_id)
+    # If this is after Unregister, there is no PlayerInfo for the player being
+    # killed.
+    if info:
+      info.alive = (
+          game_pb2.PlayerInfo.DEAD if info.alive == game_pb2.PlayerInfo.ALIVE
+          else game_pb2.PlayerInfo.ZOMBIE_DEAD)
     return True
 
 
@@ -481,3 +584,8 @@ def AddControllerArgs(parser):
       '-m', '--mode', type=game_pb2.Mode.Id.Value, default=game_pb2.Mode.BATTLE,
       help='Goals and scoring for the game, one of %s.' %
            ', '.join(game_pb2.Mode.Id.keys()))
+  parser.add_argument(
+      '--seed', type=int,
+      help=(
+          'Seed for all of the game\'s randomness, such as terrain, so that '
+          'the same moves on the same ticks play out the same way.'))
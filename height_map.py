@@ -6,6 +6,17 @@ Drawing inspiration from redblobgames.com/articles/noise/introduction.html .
 import math
 import random
 
+try:
+  import numpy
+except ImportError:
+  numpy = None  # Use the pure-Python blur.
+
+
+# Decimal places heights are rounded to. The blurs add in different orders, so
+# a height of exactly 12 may come out as 11.999999999999996 from one and 12.0
+# from another; rounding makes terrain thresholds give the same map either way.
+_PRECISION = 9
+
 
 def MakeHeightMap(
     width,
@@ -14,20 +25,37 @@ def MakeHeightMap(
     max_value,
     blur_size=2,
     ripple_amt=(0, 0),
-    ripple_period=(50, 30)):
+    ripple_period=(50, 30),
+    blur_fn=None,
+    rng=random):
+  """Returns a width x height grid (list of columns) of smoothed noise.
+
+  Args:
+    blur_fn: Override for the box blur implementation, see _BoxBlur*.
+    rng: A random.Random to draw from rather than the random module, for
+        example seeded so the same map is generated each time.
+  """
   rand_vals = []
-  smoothed = []
   scale_x = 1.0 / (ripple_period[0] / (math.pi * 2))
   scale_y = 1.0 / (ripple_period[1] / (math.pi * 2))
   for i in xrange(width):
     row = []
     for j in xrange(height):
       row.append(
-          random.randint(min_value, max_value) +
+          rng.randint(min_value, max_value) +
           ripple_amt[0] * math.sin(i * scale_x) +
           ripple_amt[1] * math.sin(j * scale_y))
     rand_vals.append(row)
-    smoothed.append([None] * height)
+  if blur_fn is None:
+    blur_fn = _BoxBlurNumpy if numpy else _BoxBlurSeparable
+  return [
+      [round(v, _PRECISION) for v in column]
+      for column in blur_fn(rand_vals, width, height, blur_size)]
+
+
+def _BoxBlurNaive(rand_vals, width, height, blur_size):
+  """Averages each cell's neighborhood directly, O(area * blur_size ** 2)."""
+  smoothed = [[None] * height for _ in xrange(width)]
   area = (2 * blur_size + 1) ** 2
   for x in xrange(width):
     for y in xrange(height):
@@ -39,6 +67,40 @@ def MakeHeightMap(
   return smoothed
 
 
+def _SlidingSums(values, blur_size):
+  """Returns wrapped-around window sums for a list, O(len(values))."""
+  n = len(values)
+  total = sum(values[k % n] for k in xrange(-blur_size, blur_size + 1))
+  sums = []
+  for k in xrange(n):
+    sums.append(total)
+    total += values[(k + blur_size + 1) % n] - values[(k - blur_size) % n]
+  return sums
+
+
+def _BoxBlurSeparable(rand_vals, width, height, blur_size):
+  """Blurs columns then rows with sliding window sums, O(area)."""
+  area = (2 * blur_size + 1) ** 2
+  column_sums = [_SlidingSums(column, blur_size) for column in rand_vals]
+  smoothed = [[None] * height for _ in xrange(width)]
+  for y in xrange(height):
+    row_sums = _SlidingSums([column[y] for column in column_sums], blur_size)
+    for x, v in enumerate(row_sums):
+      smoothed[x][y] = v / area
+  return smoothed
+
+
+def _BoxBlurNumpy(rand_vals, width, height, blur_size):
+  """Blurs with whole-array shifts along each axis."""
+  values = numpy.array(rand_vals, dtype=float)
+  for axis in (0, 1):
+    summed = numpy.zeros_like(values)
+    for k in xrange(-blur_size, blur_size + 1):
+      summed += numpy.roll(values, -k, axis=axis)
+    values = summed
+  return (values / (2 * blur_size + 1) ** 2).tolist()
+
+
 if __name__ == '__main__':
   width, height = (200, 50)
   grid = MakeHeightMap(width, height, 0, 30, ripple_amt=(2, 1))
@@ -4,12 +4,21 @@
 Example:
   # Connect to an available network server on localhost.
   %(prog)s
+  # Play in a separate game, hosted by the same server.
+  %(prog)s --host example.com --room friday
+  # Use less bandwidth for a big world, at some cost in decoding time.
+  %(prog)s --packed-blocks
+  # Use the same compression dictionary as the server, for smaller updates.
+  %(prog)s --dictionary responses.dict
+  # Play a local game with the same terrain each time.
+  %(prog)s --no-network --seed 7
 """
 
 import argparse
 
 import client
 import common
+import compression
 import controller
 import network
 
@@ -30,6 +39,21 @@ if __name__ == '__main__':
   parser.add_argument(
       '--host', default='localhost',
       help='Server to connect to for network play.')
+  parser.add_argument(
+      '--room', default='',
+      help=(
+          'Game on the server to join, or start if no one has yet. By default '
+          'the server\'s default game.'))
+  parser.add_argument(
+      '--packed-blocks', action='store_true', dest='packed_blocks',
+      help=(
+          'Ask the server to pack blocks into fixed-width records, which are '
+          'about half the size after compression.'))
+  parser.add_argument(
+      '--dictionary', metavar='FILE',
+      help=(
+          'Preset dictionary from train_dictionary.py, the same as the '
+          'server\'s, to have updates compressed with.'))
   parser.add_argument(
       '-n', '--no-network', action='store_true', dest='nonetwork',
       help='Run the game server in the same process as the client.')
@@ -38,10 +62,13 @@ if __name__ == '__main__':
 
   if args.nonetwork:
     game_server = network.LocalThreadClient(
-        args.width, args.height, args.mode, args.round)
+        args.width, args.height, args.mode, args.round, seed=args.seed)
     game_server.daemon = True
     game_server.start()
   else:
-    game_server=None
+    game_server = network.Client(
+        args.host, network.PORT, args.room, packed_blocks=args.packed_blocks,
+        dictionary=(
+            compression.Load(args.dictionary) if args.dictionary else None))
 
-  client.RunClient(args.host, args.ai, server=game_server)
+  client.RunClient(args.host, args.ai, server=game_server, room_id=args.room)
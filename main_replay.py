@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Plays back a Nuke Snake game recorded by main_server.py --record.
+
+Playback starts from any tick without reading the game up to it, using the
+keyframes in the replay file (see replay.py).
+
+Example:
+  # Watch a recorded game from the start.
+  %(prog)s replays/default-20261017-120000.replay
+  # Watch from tick 5000, at double speed.
+  %(prog)s --start 5000 --speed 2 game.replay
+  # Print each update's tick, stage and scores, as JSON lines.
+  %(prog)s --stats --start 1000 --end 2000 game.replay > stats.jsonl
+"""
+
+import argparse
+import curses
+import json
+import locale
+import logging
+import time
+
+from common import game_pb2
+import client
+import common
+import replay
+
+
+def PrintStats(reader, start_tick, end_tick=None):
+  """Prints a JSON line for each update from start_tick to end_tick."""
+  t = time.time()
+  num_updates = 0
+  for record_time, update in reader.IterUpdates(start_tick):
+    if end_tick is not None and update.tick > end_tick:
+      break
+    print json.dumps({
+        'time': record_time,
+        'tick': update.tick,
+        'round': update.round_num,
+        'stage': game_pb2.Stage.Id.Name(update.stage),
+        'full_update': update.full_update,
+        'blocks_updated': len(update.block_update),
+        'players': [
+            {'id': info.player_id,
+             'name': info.name,
+             'score': info.score,
+             'alive': game_pb2.PlayerInfo.Life.Name(info.alive)}
+            for info in update.player_info],
+    }, sort_keys=True)
+    num_updates += 1
+  logging.info(
+      'Read %d updates in %.3fs.', num_updates, time.time() - t)
+
+
+if __name__ == '__main__':
+  summary_line, _, main_doc = __doc__.partition('\n\n')
+  parser = argparse.ArgumentParser(
+      description=summary_line,
+      epilog=main_doc,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument(
+      'replay',
+      help='Replay file to play.')
+  parser.add_argument(
+      '--start', type=int, default=0, metavar='TICK',
+      help='Game tick to start playing from.')
+  parser.add_argument(
+      '--speed', type=float, default=1.0,
+      help='How many times faster than recorded to play.')
+  parser.add_argument(
+      '--stats', action='store_true',
+      help='Print each update\'s stats, rather than showing the game.')
+  parser.add_argument(
+      '--end', type=int, metavar='TICK',
+      help='Game tick to stop printing stats after.')
+  args = parser.parse_args()
+
+  if args.stats:
+    common.ConfigureLogging()
+    PrintStats(replay.Reader(args.replay), args.start, args.end)
+  else:
+    log_filename = '/tmp/nukesnake_replay_log.txt'
+    print 'log file %s' % log_filename
+    common.ConfigureLogging(filename=log_filename)
+    locale.setlocale(locale.LC_ALL, '')
+    game_server = replay.PlaybackServer(
+        replay.Reader(args.replay), args.start, args.speed)
+    try:
+      curses.wrapper(client.Client.CursesWrappedLoop, client.Client(game_server))
+    except KeyboardInterrupt:
+      print 'Quitting.'
@@ -4,12 +4,21 @@
 Example:
   # Run a server with a 200x50 block world.
   %(prog)s --width 200 --height 50
+  # Run rooms in 4 worker processes, to use 4 cores.
+  %(prog)s --workers 4
+  # Compress updates with a dictionary from train_dictionary.py, for clients
+  # which have it too.
+  %(prog)s --dictionary responses.dict
+  # Record each room's game, to watch later with main_replay.py.
+  %(prog)s --record replays
 """
 import argparse
 
 import common
+import compression
 import controller
 import network
+import sharding
 
 
 PORT = 9988
@@ -25,9 +34,59 @@ if __name__ == '__main__':
   parser.add_argument(
       '--host', default='',
       help='Hostname to bind to when serving network play.')
+  parser.add_argument(
+      '--terrain-pool', type=int, default=0, dest='terrain_pool',
+      help=(
+          'Number of maps to pre-generate in a background process, so new '
+          'rounds start without waiting for terrain generation.'))
+  parser.add_argument(
+      '--profile', type=float, default=0, metavar='SECONDS',
+      help=(
+          'Time each phase of the server loop and log latency percentiles '
+          'and overrun counts at this interval.'))
+  parser.add_argument(
+      '--keyframe-interval', type=float, default=5.0, metavar='SECONDS',
+      dest='keyframe_interval',
+      help=(
+          'How often to send all clients a full update, so that any lost '
+          'updates are recovered from. Zero to disable.'))
+  parser.add_argument(
+      '--send-rate', type=float, default=60.0, metavar='HZ', dest='send_rate',
+      help=(
+          'Most updates to send clients per second. Changes from faster game '
+          'ticks are combined. Zero to send after every tick.'))
+  parser.add_argument(
+      '--workers', type=int, default=0,
+      help=(
+          'Number of worker processes to run rooms in. Zero to run them all '
+          'in this process. See sharding.py for draining a worker.'))
+  parser.add_argument(
+      '--dictionary', metavar='FILE',
+      help=(
+          'Preset dictionary from train_dictionary.py to compress updates '
+          'with, for clients which have the same one.'))
+  parser.add_argument(
+      '--record', metavar='DIR',
+      help=(
+          'Directory to record each room\'s game to, as a replay file '
+          'named for the room and start time.'))
   controller.AddControllerArgs(parser)
   args = parser.parse_args()
 
-  server = network.Server(
-      args.host, PORT, args.width, args.height, args.mode, args.round)
-  server.ListenAndUpdateForever()
+  server_args = (args.width, args.height, args.mode, args.round)
+  server_kwargs = dict(
+      terrain_pool_size=args.terrain_pool,
+      profile_interval=args.profile,
+      keyframe_interval=args.keyframe_interval,
+      send_rate=args.send_rate,
+      seed=args.seed,
+      record_dir=args.record,
+      dictionary=(
+          compression.Load(args.dictionary) if args.dictionary else None))
+  if args.workers > 0:
+    router = sharding.Router(
+        args.host, PORT, args.workers, *server_args, **server_kwargs)
+    router.ListenAndForwardForever()
+  else:
+    server = network.Server(args.host, PORT, *server_args, **server_kwargs)
+    server.ListenAndUpdateForever()
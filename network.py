@@ -8,49 +8,308 @@ See main_* for running a server and clients.
 import argparse
 import errno
 import collections
+import hashlib
 import logging
+import os
+import re
+import select
 import socket
+import struct
 import threading
 import time
 import zlib
 
-from common import network_pb2, message
+from common import game_pb2, network_pb2, message
+import block_codec
 import common
+import compression
 import controller
+import profiling
+import replay
 
 
 PORT = 9988
+# Prefixed by sharding.Router to each datagram it forwards to a worker: the
+# client's IPv4 address and port.
+_FORWARD_HEADER = struct.Struct('!4sH')
+# Requests which change the game, recorded in replays with the player ID their
+# secret has before they are handled. REGISTERs are recorded after, with the
+# ID they get.
+_RECORDED_COMMANDS = frozenset((
+    network_pb2.Request.MOVE,
+    network_pb2.Request.ACTION,
+    network_pb2.Request.UNREGISTER))
+
+
+def _EncodeVarint(n):
+  parts = []
+  while n > 0x7f:
+    parts.append(chr(0x80 | (n & 0x7f)))
+    n >>= 7
+  parts.append(chr(n))
+  return ''.join(parts)
+
+
+def _LengthDelimitedField(field_number, data):
+  return _EncodeVarint(field_number << 3 | 2) + _EncodeVarint(len(data)) + data
+
+
+def _SplitRepeatedFields(data, field_numbers):
+  """Splits a serialized message without parsing it.
+
+  Args:
+    data: A serialized proto.
+    field_numbers: Numbers of repeated length-delimited fields.
+  Returns:
+    The serialized fields other than field_numbers', and a list of each
+    serialized entry of those (including its key and length), in order.
+  """
+  field_keys = set(field_number << 3 | 2 for field_number in field_numbers)
+  other_fields = []
+  repeated_fields = []
+  i = 0
+  while i < len(data):
+    start = i
+    key = shift = 0
+    while True:
+      b = ord(data[i])
+      i += 1
+      key |= (b & 0x7f) << shift
+      shift += 7
+      if b < 0x80:
+        break
+    wire_type = key & 0x7
+    if wire_type == 0:  # varint
+      while ord(data[i]) >= 0x80:
+        i += 1
+      i += 1
+    elif wire_type == 1:  # 64-bit
+      i += 8
+    elif wire_type == 2:  # length-delimited
+      length = shift = 0
+      while True:
+        b = ord(data[i])
+        i += 1
+        length |= (b & 0x7f) << shift
+        shift += 7
+        if b < 0x80:
+          break
+      i += length
+    elif wire_type == 5:  # 32-bit
+      i += 4
+    else:
+      raise ValueError('Unsupported wire type %d.' % wire_type)
+    if key in field_keys:
+      repeated_fields.append(data[start:i])
+    else:
+      other_fields.append(data[start:i])
+  return ''.join(other_fields), repeated_fields
+
+
+_BLOCK_UPDATE_FIELD = network_pb2.Response.BLOCK_UPDATE_FIELD_NUMBER
+_CHUNK_INFO_FIELD = network_pb2.Response.CHUNK_INFO_FIELD_NUMBER
+_PACKED_BLOCKS_FIELD = network_pb2.Response.PACKED_BLOCKS_FIELD_NUMBER
+_TERRAIN_RUNS_FIELD = network_pb2.Response.TERRAIN_RUNS_FIELD_NUMBER
+# Blocks per packed_blocks entry, small enough for a few to fit in a datagram.
+_PACKED_GROUP_SIZE = 128
+# How a client asked for responses: with blocks packed or not, and compressed
+# with a compression.PresetDictionary or not.
+_Encoding = collections.namedtuple('Encoding', ('packed', 'dictionary'))
+_PLAIN_ENCODING = _Encoding(packed=False, dictionary=None)
+
+
+def _GetBlocksArea(response):
+  """Returns the x, y, width and height which a response's blocks are within."""
+  if response.HasField('view_origin'):
+    return (response.view_origin.x, response.view_origin.y,
+            response.view_size.x, response.view_size.y)
+  return 0, 0, response.size.x, response.size.y
+
+
+def _PackBlocks(response):
+  """Returns a copy of response with its blocks in packed_blocks.
+
+  The terrain of a full update is sent as terrain_runs instead.
+  """
+  packed = network_pb2.Response()
+  packed.CopyFrom(response)
+  packed.ClearField('block_update')
+  blocks = response.block_update
+  if response.full_update:
+    x0, y0, width, height = _GetBlocksArea(response)
+    runs, blocks = block_codec.PackTerrainRuns(blocks, width, height, x0, y0)
+    packed.terrain_runs.extend(runs)
+  for i in xrange(0, len(blocks), _PACKED_GROUP_SIZE):
+    packed.packed_blocks.append(
+        block_codec.Pack(blocks[i:i + _PACKED_GROUP_SIZE]))
+  return packed
+
+
+class _Reassembler(object):
+  """Joins chunked responses, keeping a bounded number of segments in flight.
+
+  Segments missing a chunk are dropped when they get too old, or when too
+  many newer segments have started.
+  """
+  _MAX_SEGMENTS = 8
+  _MAX_AGE = 2.0  # seconds
+  _REPORT_INTERVAL = 50  # segments
+  _Segment = collections.namedtuple(
+      'Segment', ('chunks_by_index', 'num_chunks', 'start_time'))
+
+  def __init__(self, max_segments=_MAX_SEGMENTS, max_age=_MAX_AGE):
+    self._max_segments = max_segments
+    self._max_age = max_age
+    self._segments_by_key = collections.OrderedDict()  # oldest first
+    self._completed_keys = collections.deque(maxlen=4 * max_segments)
+
+    # stats on reassembly
+    self.num_completed = 0
+    self.num_duplicates = 0
+    self.num_dropped = 0  # when too many segments were in flight
+    self.num_expired = 0
+    self._num_reported = 0
+
+  def Add(self, chunk, sender_addr):
+    """Returns the whole response once all its chunks are added, else None."""
+    t = time.time()
+    while self._segments_by_key:
+      key, oldest = next(self._segments_by_key.iteritems())
+      if t - oldest.start_time <= self._max_age:
+        break
+      del self._segments_by_key[key]
+      self.num_expired += 1
+
+    info = chunk.chunk_info
+    key = (sender_addr, info.segment_id)
+    segment = self._segments_by_key.get(key)
+    if segment is None:
+      if key in self._completed_keys:
+        self.num_duplicates += 1
+        return None
+      if len(self._segments_by_key) >= self._max_segments:
+        self._segments_by_key.popitem(last=False)
+        self.num_dropped += 1
+      segment = self._Segment(
+          chunks_by_index={}, num_chunks=[None], start_time=t)
+      self._segments_by_key[key] = segment
+    if info.chunk_index in segment.chunks_by_index:
+      self.num_duplicates += 1
+      return None
+    segment.chunks_by_index[info.chunk_index] = chunk
+    if info.last_chunk:
+      segment.num_chunks[0] = info.chunk_index + 1
+    if len(segment.chunks_by_index) != segment.num_chunks[0]:
+      return None
+
+    del self._segments_by_key[key]
+    self._completed_keys.append(key)
+    self.num_completed += 1
+    self._MaybeReport()
+    first = segment.chunks_by_index[0]
+    for i in xrange(1, segment.num_chunks[0]):
+      chunk = segment.chunks_by_index[i]
+      first.block_update.extend(chunk.block_update)
+      first.packed_blocks.extend(chunk.packed_blocks)
+      first.terrain_runs.extend(chunk.terrain_runs)
+    return first
+
+  def _MaybeReport(self):
+    if self.num_completed - self._num_reported < self._REPORT_INTERVAL:
+      return
+    self._num_reported = self.num_completed
+    if self.num_dropped or self.num_expired:
+      logging.info(
+          'Reassembled %d segments, dropped %d incomplete (%d expired), '
+          'ignored %d duplicate chunks.',
+          self.num_completed,
+          self.num_dropped + self.num_expired,
+          self.num_expired,
+          self.num_duplicates)
 
 
 class _ProtoSocket(object):
-  _STOP = '\xc3\0\0\xdb'  # magic string unlikely to appear in proto stream
+  """Sends and receives compressed protos, one per datagram or chunk."""
   _TIMEOUT = 3.0
   # max size allowed by socket library for UDP is [9214, 9224)
   _BUFFER_SIZE = 9214
+  # Keep datagrams within a 1500 byte Ethernet MTU, after IP and UDP headers
+  # and some room for tunnels, so they are not fragmented.
+  _MAX_DATAGRAM_SIZE = 1400
+  _CHUNK_INFO_SIZE = 16  # upper bound on a serialized chunk_info field
   _CHUNK_REPORT_INTERVAL = 50
-  _Segment = collections.namedtuple(
-      'Segment', ('chunks', 'indices', 'has_last'))
 
-  def __init__(self, sock, response_cls, default_addr=None):
+  def __init__(
+      self, sock, response_cls, default_addr=None,
+      phase_timer=profiling.NULL_TIMER, max_datagram_size=_MAX_DATAGRAM_SIZE,
+      forwarded=False, dictionary=None):
+    """Wraps a UDP socket.
+
+    Args:
+      forwarded: Whether received datagrams start with a _FORWARD_HEADER, to
+          be read as their sender address.
+      dictionary: A compression.PresetDictionary to decompress any received
+          datagrams compressed with it.
+    """
+    self._phase_timer = phase_timer
+    self._forwarded = forwarded
+    self._dictionary = dictionary
+    self._max_datagram_size = min(max_datagram_size, self._BUFFER_SIZE)
     self._sock = sock
     self._sock.settimeout(0.0)  # non-blocking
     self._response_cls = response_cls
-    self._buffer = ''
+    self._recv_buffer = bytearray(self._BUFFER_SIZE)
     self._default_addr = default_addr
 
     self._next_segment_id = 1
-    self._segments_by_id = collections.defaultdict(
-        lambda: self._Segment(chunks=[], indices=set(), has_last=[False]))
+    self._reassembler = _Reassembler()
 
     # stats on packet size
     self._num_writes = 0
     self._num_chunked = 0
     self._min_overflow = float('Inf')
     self._max_safe = 0
+    # Bytes sent count each recipient; bytes encoded only count each encoding.
+    self.bytes_encoded = 0
+    self.bytes_sent = 0
+
+  def Write(self, proto, dest_addrs=[], packed=False, dictionary=None):
+    self.Send(self.Encode(proto, packed, dictionary), dest_addrs)
 
-  def Write(self, proto, dest_addrs=[], chunked=False):
-    # Note zlib gets consistent 60% compression on large (200x50) worlds.
-    data = zlib.compress(proto.SerializeToString()) + self._STOP
+  def Encode(self, proto, packed=False, dictionary=None):
+    """Serializes and compresses proto once, into datagrams for Send.
+
+    Protos too big for one datagram are split into chunks by encoded size,
+    if they have chunk_info.
+
+    Args:
+      packed: Whether to send a Response's blocks as packed_blocks.
+      dictionary: A compression.PresetDictionary to compress with, if any.
+    """
+    with self._phase_timer.Phase('encode'):
+      repeated_fields = (_BLOCK_UPDATE_FIELD,)
+      if packed and (proto.block_update or proto.full_update):
+        proto = _PackBlocks(proto)
+        repeated_fields = (_TERRAIN_RUNS_FIELD, _PACKED_BLOCKS_FIELD)
+      data = proto.SerializeToString()
+      # Note zlib gets consistent 60% compression on large (200x50) worlds.
+      compressed = compression.Compress(data, dictionary)
+      if len(compressed) <= self._max_datagram_size:
+        datagrams = [compressed]
+      elif hasattr(proto, 'chunk_info'):
+        self._num_chunked += 1
+        datagrams = self._EncodeChunked(
+            data, float(len(compressed)) / len(data), repeated_fields,
+            dictionary)
+      else:
+        logging.error(
+            'Error: Non-chunkable proto is %d bytes > max %d bytes: %s...',
+            len(compressed), self._max_datagram_size,
+            str(proto).replace('\n', ' ')[:100])
+        datagrams = []
+
+    self.bytes_encoded += sum(len(d) for d in datagrams)
+    self._num_writes += 1
     if self._num_writes >= self._CHUNK_REPORT_INTERVAL:
       if self._num_chunked > 0:
         logging.info(
@@ -60,23 +319,57 @@ class _ProtoSocket(object):
             int(100 * float(self._num_chunked)/self._num_writes))
       self._num_writes = 0
       self._num_chunked = 0
-    if not chunked:
-      self._num_writes += 1
-    if len(data) > self._BUFFER_SIZE:
-      if hasattr(proto, 'chunk_info') and not chunked:
-        self._num_chunked += 1
-        self._WriteChunked(proto, len(data), dest_addrs)
-      else:
-        logging.error(
-            'Error: Non-chunkable proto is %d bytes > buffer %d bytes: %s...',
-            len(data), self._BUFFER_SIZE, str(proto).replace('\n', ' ')[:100])
-      return
+    return datagrams
+
+  def _EncodeChunked(
+      self, data, compression_ratio, repeated_fields, dictionary):
+    """Splits serialized data between datagrams by repeated field sizes.
+
+    Only the first chunk has the fields other than repeated_fields (blocks,
+    packed or not). Each chunk is compressed separately, so the budget shrinks
+    if a chunk compresses worse than the whole did.
+    """
+    header, block_fields = _SplitRepeatedFields(data, repeated_fields)
+    segment_id = self._next_segment_id
+    self._next_segment_id += 1
+    budget = (
+        (self._max_datagram_size - self._CHUNK_INFO_SIZE) /
+        compression_ratio)
+    while True:
+      groups = [[header]]
+      group_size = len(header)
+      for field in block_fields:
+        if group_size + len(field) > budget and group_size > 0:
+          groups.append([])
+          group_size = 0
+        groups[-1].append(field)
+        group_size += len(field)
+
+      datagrams = []
+      for chunk_index, group in enumerate(groups):
+        chunk_info = network_pb2.Chunk(
+            segment_id=segment_id,
+            chunk_index=chunk_index,
+            last_chunk=chunk_index == len(groups) - 1)
+        group.append(_LengthDelimitedField(
+            _CHUNK_INFO_FIELD, chunk_info.SerializeToString()))
+        datagrams.append(compression.Compress(''.join(group), dictionary))
+      if (max(len(d) for d in datagrams) <= self._max_datagram_size or
+          len(groups) > len(block_fields)):  # Can't split any further.
+        return datagrams
+      budget *= 0.75
+
+  def Send(self, datagrams, dest_addrs=[]):
+    """Sends the same encoded datagrams to each address."""
+    if self._default_addr:
+      dest_addrs = list(dest_addrs) + [self._default_addr]
     try:
-      for dest_addr in dest_addrs:
-        self._sock.sendto(data, dest_addr)
-      if self._default_addr:
-        self._sock.sendto(data, self._default_addr)
-      self._max_safe = max(self._max_safe, len(data))
+      with self._phase_timer.Phase('send'):
+        for dest_addr in dest_addrs:
+          for data in datagrams:
+            self._sock.sendto(data, dest_addr)
+            self.bytes_sent += len(data)
+            self._max_safe = max(self._max_safe, len(data))
     except socket.error, (n, msg):
       logging.error('Error %d sending: %s' % (n, msg))
       if n == errno.EMSGSIZE:
@@ -87,141 +380,280 @@ class _ProtoSocket(object):
       else:
         raise
 
-  def _WriteChunked(self, proto, oversize, dest_addrs):
-    # TODO: Generalize (for request too / for arbitrary fields)?
-    num_chunks = oversize / self._BUFFER_SIZE + 2
-    remaining_block_list = list(proto.block_update)
-    blocks_per_chunk = (len(remaining_block_list) / num_chunks) + 1
-    del proto.block_update[:]
-    chunk_index = 0
-    while remaining_block_list:
-      block_chunk = remaining_block_list[:blocks_per_chunk]
-      remaining_block_list = remaining_block_list[blocks_per_chunk:]
-      chunk = proto.__class__(
-          block_update=block_chunk,
-          chunk_info=network_pb2.Chunk(
-              segment_id=self._next_segment_id,
-              chunk_index=chunk_index,
-              last_chunk=not remaining_block_list))
-      chunk.MergeFrom(proto)
-      self.Write(chunk, dest_addrs, chunked=True)
-      chunk_index += 1
-    self._next_segment_id += 1
+  def _Receive(self):
+    """Receives one datagram, which may raise socket.error.
 
-  def _RemoveAndReturnChunked(self, chunk):
-    segment = self._segments_by_id[chunk.chunk_info.segment_id]
-    segment.indices.add(chunk.chunk_info.chunk_index)
-    segment.chunks.append(chunk)
-    segment.has_last[0] |= chunk.chunk_info.last_chunk
-    if segment.has_last[0] and max(segment.indices) == len(segment.chunks) - 1:
-      del self._segments_by_id[chunk.chunk_info.segment_id]
-      ordered = segment.chunks
-      ordered.sort(key=lambda chunk: chunk.chunk_info.chunk_index)
-      first = ordered[0]
-      for chunk in ordered[1:]:
-        first.block_update.extend(chunk.block_update)
-      return first
-    return None
+    Returns:
+      The proto it completes, if any, and its sender address.
+    """
+    size, sender_addr = self._sock.recvfrom_into(self._recv_buffer)
+    offset = 0
+    if self._forwarded:
+      offset = _FORWARD_HEADER.size
+      if size < offset:
+        return None, sender_addr
+      packed_host, port = _FORWARD_HEADER.unpack_from(self._recv_buffer)
+      sender_addr = (socket.inet_ntoa(packed_host), port)
+    return self._Decode(size, sender_addr, offset), sender_addr
 
-  def _RemoveAndReturnProtoFromBuffer(self):
-    proto_data, found_stop, rest = self._buffer.partition(self._STOP)
-    if not found_stop:
-      return None
-    self._buffer = rest
+  def _Decode(self, size, sender_addr, offset=0):
+    """Returns the proto received into the buffer, if it completes one."""
     try:
-      proto = self._response_cls.FromString(zlib.decompress(proto_data))
-      if hasattr(proto, 'chunk_info') and proto.HasField('chunk_info'):
-        return self._RemoveAndReturnChunked(proto)
-      else:
-        return proto
-    except message.DecodeError:
-      logging.error('Decoding error of %r.', proto_data)
+      proto = self._response_cls.FromString(compression.Decompress(
+          buffer(self._recv_buffer, offset, size - offset), self._dictionary))
+    except (zlib.error, message.DecodeError):
+      logging.error(
+          'Decoding error of %d bytes from %s:%d.',
+          size, sender_addr[0], sender_addr[1])
       return None
+    if hasattr(proto, 'chunk_info') and proto.HasField('chunk_info'):
+      proto = self._reassembler.Add(proto, sender_addr)
+    if isinstance(proto, network_pb2.Response):
+      if proto.terrain_runs:
+        x0, y0, _, height = _GetBlocksArea(proto)
+        for runs in proto.terrain_runs:
+          block_codec.UnpackTerrainRunsInto(
+              runs, height, x0, y0, proto.block_update)
+        proto.ClearField('terrain_runs')
+      if proto.packed_blocks:
+        for packed in proto.packed_blocks:
+          block_codec.UnpackInto(packed, proto.block_update)
+        proto.ClearField('packed_blocks')
+    return proto
 
   def ReadBlocking(self):
     self._sock.settimeout(self._TIMEOUT)
-    while True:
-      # may raise socket.timeout
-      new_data, sender_addr = self._sock.recvfrom(self._BUFFER_SIZE)
-      self._buffer += new_data
-      proto = self._RemoveAndReturnProtoFromBuffer()
+    try:
+      while True:
+        proto, sender_addr = self._Receive()  # may raise socket.timeout
+        if proto:
+          return proto, sender_addr
+    finally:
+      self._sock.settimeout(0.0)
+
+  def ReadBatch(self, max_datagrams):
+    """Receives pending datagrams, without blocking.
+
+    Args:
+      max_datagrams: Stop after this many, so a flood can't stall the caller.
+    Returns:
+      A list of (proto, sender_addr) for each whole proto received.
+    """
+    received = []
+    for _ in xrange(max_datagrams):
+      try:
+        proto, sender_addr = self._Receive()
+      except socket.error:
+        break  # no data right now
       if proto:
-        self._sock.settimeout(0.0)
-        return proto, sender_addr
+        received.append((proto, sender_addr))
+    return received
 
-  def Read(self):
-    try:
-      new_data, sender_addr = self._sock.recvfrom(self._BUFFER_SIZE)
-    except socket.error:
-      return None, None  # no data right now
-    self._buffer += new_data
-    return self._RemoveAndReturnProtoFromBuffer(), sender_addr
+  def fileno(self):
+    return self._sock.fileno()
 
   def Close(self):
     self._sock.close()
 
 
-_UPDATE_INTERVAL = 1 / 60.0
+_UPDATE_INTERVAL = 1 / 60.0  # time budget for the work of one server loop
 
 
-class Server(object):
+def _IntersectRects(a, b):
+  """Returns the overlap of two (x0, y0, x1, y1) rects, or None."""
+  x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+  x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+  if x0 >= x1 or y0 >= y1:
+    return None
+  return x0, y0, x1, y1
+
+
+def _SubtractRect(rect, other):
+  """Returns a list of non-overlapping rects covering rect but not other."""
+  inner = _IntersectRects(rect, other)
+  if not inner:
+    return [rect]
+  x0, y0, x1, y1 = rect
+  ix0, iy0, ix1, iy1 = inner
+  parts = [
+      (x0, y0, ix0, y1),  # left
+      (ix1, y0, x1, y1),  # right
+      (ix0, y0, ix1, iy0),  # above
+      (ix0, iy1, ix1, y1),  # below
+  ]
+  return [(a, b, c, d) for a, b, c, d in parts if a < c and b < d]
+
+
+class _ClientView(object):
+  """The part of the world a client is sent, which follows a player's head."""
+  def __init__(self, secret, size):
+    self.secret = secret
+    self._size = size  # as requested, before clipping to the world
+    self._origin = None
+    # (x0, y0, x1, y1) sent with each tick, oldest first
+    self._rects_by_tick = collections.OrderedDict()
+
+  def CoversWorld(self, world_size):
+    return self._size.x >= world_size.x and self._size.y >= world_size.y
+
+  def Scroll(self, game, world_size):
+    """Moves the view to follow its player, and returns it as a rect."""
+    size = game_pb2.Coordinate(
+        x=min(self._size.x, world_size.x), y=min(self._size.y, world_size.y))
+    self._origin = common.ScrollView(
+        self._origin, size, world_size, game.GetPlayerPos(self.secret))
+    return (
+        self._origin.x, self._origin.y,
+        self._origin.x + size.x, self._origin.y + size.y)
+
+  def Record(self, tick, rect):
+    if tick in self._rects_by_tick:
+      # Either response for this tick may be the one the client kept.
+      rect = _IntersectRects(rect, self._rects_by_tick[tick]) or (0, 0, 0, 0)
+    self._rects_by_tick[tick] = rect
+    while len(self._rects_by_tick) > _Room._HISTORY_LENGTH:
+      self._rects_by_tick.popitem(last=False)
+
+  def GetSeenSince(self, base_tick):
+    """Returns the rect which was in view for every tick sent since base_tick.
+
+    Returns None if that is unknown or empty.
+    """
+    if base_tick not in self._rects_by_tick:
+      return None
+    seen = self._rects_by_tick[base_tick]
+    for tick in reversed(self._rects_by_tick):
+      if tick <= base_tick or not seen:
+        break
+      seen = _IntersectRects(seen, self._rects_by_tick[tick])
+    return seen
+
+
+class _Room(object):
+  """One game hosted by a Server, and the clients connected to it."""
   _CLIENT_ROUNDS_TIMEOUT = 3
+  # Clients which last ACKed a state older than this many states ago get a
+  # full update rather than the changes since.
+  _HISTORY_LENGTH = 60
   _ClientConnection = collections.namedtuple(
-      'ClientConnection', ('activity', 'secrets', 'names'))
+      'ClientConnection',
+      ('activity', 'secrets', 'names', 'acked_tick', 'view', 'encoding'))
 
-  def __init__(self, host, port, width, height, mode, starting_round):
-    self._game = controller.Controller(width, height, mode, starting_round)
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.bind((host, port))
-    self._sock = _ProtoSocket(s, network_pb2.Request)
-    logging.info('Listening on %s:%d.', host, port)
+  def __init__(
+      self, room_id, sock, game, phase_timer, keyframe_interval, send_rate,
+      record_input=False, dictionary=None, recorder=None):
+    self.room_id = room_id
+    self._sock = sock
+    self._dictionary = dictionary
+    self._game = game
+    self._phase_timer = phase_timer
+    self._record_input = record_input
+    self._input_times = []  # when each MOVE or ACTION arrived, if recording
+    self._recorder = recorder  # a replay.Recorder for the game, if any
 
     self._active_clients_by_addr = {}
-    self._last_round = 0
+    # Starting from the game's round, so that clients active before its first
+    # state don't look rounds out of date once it is sent.
+    self._last_round = game.round_num
     self._last_state_hash = None
+    self._history = collections.deque(maxlen=self._HISTORY_LENGTH)
+    self._keyframe_interval = keyframe_interval
+    self._last_keyframe_time = time.time()
+    self._resync_addrs = set()
+    self._encoded_full_state = None
+    self._full_state_datagrams = {}  # by _Encoding
+    self._send_interval = 1.0 / send_rate if send_rate > 0 else 0.0
+    self._next_send_time = 0.0
+    self._has_unsent_ticks = False
 
-  def ListenAndUpdateForever(self):
-    try:
-      while True:
-        t = time.time()
-        self._ReadClientRequests()
-        updates = self._UpdateController()
-        self._DistributeUpdates(updates)
-        self._UnregisterInactiveClients()
-        used_dt = time.time() - t
-        if used_dt < _UPDATE_INTERVAL:
-          time.sleep(_UPDATE_INTERVAL - used_dt)
-    except KeyboardInterrupt:
-      pass
-    finally:
-      logging.info('Closing listening socket.')
-      self._sock.Close()
+    # stats on the cost of running this room, since it opened
+    self.last_request_time = time.time()
+    self.num_ticks = 0
+    self.busy_seconds = 0.0
 
-  def _ReadClientRequests(self):
-    request, client_addr = self._sock.Read()
-    while request:
-      logging.debug(
-          'Client %s:%d sends: %s',
-          client_addr[0], client_addr[1], str(request).replace('\n', ' '))
-      if not request.HasField('command'):
-        logging.error('Ignoring empty request!')
-        break
-      self._RecordClientActive(client_addr, request.secret, request.name)
-      if request.command == network_pb2.Request.REGISTER:
-        player_id = self._game.Register(request.secret, request.name)
-        logging.info('Registered player %d with Controller.', player_id)
-        self._sock.Write(
-            network_pb2.Response(player_id=player_id), [client_addr])
-      elif request.command == network_pb2.Request.MOVE:
-        self._game.Move(request.secret, request.direction)
-      elif request.command == network_pb2.Request.ACTION:
-        self._game.Action(request.secret)
-      elif request.command == network_pb2.Request.UNREGISTER:
-        # Client connection info will be auto-removed on timeout.
-        self._game.Unregister(request.secret)
+  @property
+  def num_skipped_ticks(self):
+    return self._game.num_skipped_ticks
+
+  def IsIdle(self, timeout):
+    return (
+        not self._game.HasPlayers() and
+        time.time() - self.last_request_time > timeout)
+
+  def Close(self):
+    self._game.Close()
+    if self._recorder:
+      self._recorder.Close()
+
+  def GetWakeTime(self):
+    """Returns when Update next has work to do, as a time.time() value."""
+    wake_time = self._game.GetNextUpdateTime()
+    if self._has_unsent_ticks:
+      wake_time = min(wake_time, self._next_send_time)
+    return wake_time
+
+  def Update(self):
+    """Runs ticks due and sends updates, keeping track of the time taken."""
+    t = time.time()
+    updates = self._UpdateController()
+    self._DistributeUpdates(updates)
+    self._UnregisterInactiveClients()
+    self.busy_seconds += time.time() - t
+
+  def HandleRequest(self, request, client_addr):
+    self.last_request_time = time.time()
+    self._RecordClientActive(client_addr, request.secret, request.name)
+    if request.HasField('view_size'):
+      view = None
+      if request.view_size.x > 0 and request.view_size.y > 0:
+        view = _ClientView(request.secret, request.view_size)
+      self._active_clients_by_addr[client_addr].view[0] = view
+    if self._recorder and request.command in _RECORDED_COMMANDS:
+      self._recorder.RecordRequest(
+          self._game.tick, self._game.GetPlayerId(request.secret), request)
+    if request.command == network_pb2.Request.REGISTER:
+      self._active_clients_by_addr[client_addr].encoding[0] = (
+          self._GetEncoding(request))
+      player_id = self._game.Register(request.secret, request.name)
+      logging.info(
+          'Registered player %d in room %r.', player_id, self.room_id)
+      if self._recorder:
+        self._recorder.RecordRequest(self._game.tick, player_id, request)
+      self._sock.Write(
+          network_pb2.Response(player_id=player_id), [client_addr])
+    elif request.command == network_pb2.Request.MOVE:
+      self._game.Move(request.secret, request.direction)
+      self._RecordInput()
+    elif request.command == network_pb2.Request.ACTION:
+      self._game.Action(request.secret)
+      self._RecordInput()
+    elif request.command == network_pb2.Request.UNREGISTER:
+      # Client connection info will be auto-removed on timeout.
+      self._game.Unregister(request.secret)
+    elif request.command == network_pb2.Request.ACK:
+      acked_tick = self._active_clients_by_addr[client_addr].acked_tick
+      if acked_tick[0] is None or request.ack_tick > acked_tick[0]:
+        acked_tick[0] = request.ack_tick
+    elif request.command == network_pb2.Request.RESYNC:
+      self._active_clients_by_addr[client_addr].acked_tick[0] = None
+      self._resync_addrs.add(client_addr)
+    else:
+      logging.error('Ignoring unrecognized client request: %s', request)
+
+  def _GetEncoding(self, request):
+    dictionary = None
+    if request.HasField('dictionary_id'):
+      if self._dictionary and request.dictionary_id == self._dictionary.dict_id:
+        dictionary = self._dictionary
       else:
-        logging.error('Ignoring unrecognized client request: %s', request)
-      request, client_addr = self._sock.Read()
+        logging.info(
+            'Not using client dictionary %08x, which the server lacks.',
+            request.dictionary_id)
+    return _Encoding(packed=request.packed_blocks, dictionary=dictionary)
+
+  def _RecordInput(self):
+    if self._record_input:
+      self._input_times.append(time.time())
 
   def _RecordClientActive(self, client_addr, secret, name=None):
     client_connection = self._active_clients_by_addr.get(client_addr)
@@ -235,20 +667,193 @@ class Server(object):
       self._active_clients_by_addr[client_addr] = self._ClientConnection(
           activity=[time.time()],
           secrets=set([secret]),
-          names=set([name]) if name else set())
+          names=set([name]) if name else set(),
+          acked_tick=[None],
+          view=[None],
+          encoding=[_PLAIN_ENCODING])
 
   def _UpdateController(self):
-    if self._game.Update():
-      self._last_state_hash, new_state = self._game.GetGameState(
-          self._last_state_hash)
+    with self._phase_timer.Phase('update'):
+      num_ticks = self._game.Update()
+    if num_ticks:
+      self.num_ticks += num_ticks
+      self._has_unsent_ticks = True
+    t = time.time()
+    if self._has_unsent_ticks and t >= self._next_send_time:
+      self._has_unsent_ticks = False
+      self._next_send_time += self._send_interval
+      if self._next_send_time < t:
+        self._next_send_time = t + self._send_interval
+      with self._phase_timer.Phase('get_state'):
+        self._last_state_hash, new_state = self._game.GetGameState(
+            self._last_state_hash)
       if new_state:
         self._last_round = new_state.round_num
+        if self._recorder:
+          self._recorder.RecordUpdate(new_state)
         return [new_state]
     return []
 
   def _DistributeUpdates(self, updates):
-    for update_response in updates:
-      self._sock.Write(update_response, self._active_clients_by_addr.keys())
+    """Sends each client the changes since the last tick it ACKed.
+
+    Clients without a usable ACK, or which asked to resync, share one full
+    update. Between game state changes only resyncing clients are sent to,
+    and before the first state they wait for it.
+    """
+    if not updates and not self._history:
+      return
+    resync_addrs = self._resync_addrs
+    self._resync_addrs = set()
+    if not updates:
+      if resync_addrs:
+        self._SendFullUpdates(resync_addrs)
+      return
+    self._history.extend(updates)
+
+    t = time.time()
+    for input_time in self._input_times:
+      self._phase_timer.Record('input_latency', t - input_time)
+    del self._input_times[:]
+    if (self._keyframe_interval > 0 and
+        t - self._last_keyframe_time >= self._keyframe_interval):
+      self._last_keyframe_time = t
+      self._SendFullUpdates(self._active_clients_by_addr.keys())
+      return
+
+    addrs_by_base_tick = collections.defaultdict(list)
+    oldest_tick = self._history[0].tick
+    for addr, conn in self._active_clients_by_addr.iteritems():
+      base_tick = conn.acked_tick[0]
+      if (addr in resync_addrs or
+          (base_tick is not None and base_tick < oldest_tick)):
+        base_tick = None
+      addrs_by_base_tick[base_tick].append(addr)
+    for base_tick, addrs in addrs_by_base_tick.iteritems():
+      if base_tick is None:
+        self._SendFullUpdates(addrs)
+        continue
+      merged = self._MergeHistorySince(base_tick)
+      whole_world_addrs = []
+      for addr in addrs:
+        view = self._GetView(addr)
+        if view:
+          self._SendViewUpdate(addr, view, merged)
+        else:
+          whole_world_addrs.append(addr)
+      if whole_world_addrs:
+        self._Write(merged, whole_world_addrs)
+
+  def _GetView(self, addr):
+    """Returns the client's view, if it has one smaller than the world."""
+    view = self._active_clients_by_addr[addr].view[0]
+    if view and not view.CoversWorld(self._history[-1].size):
+      return view
+    return None
+
+  def _SendFullUpdates(self, addrs):
+    whole_world_addrs = []
+    for addr in addrs:
+      view = self._GetView(addr)
+      if view:
+        self._SendViewUpdate(addr, view, None)
+      else:
+        whole_world_addrs.append(addr)
+    for encoding, encoding_addrs in self._GroupByEncoding(whole_world_addrs):
+      self._sock.Send(
+          self._GetFullGameStateDatagrams(encoding), encoding_addrs)
+
+  def _GroupByEncoding(self, addrs):
+    """Yields (_Encoding, addrs) for the clients which asked for each."""
+    addrs_by_encoding = collections.defaultdict(list)
+    for addr in addrs:
+      addrs_by_encoding[
+          self._active_clients_by_addr[addr].encoding[0]].append(addr)
+    return addrs_by_encoding.iteritems()
+
+  def _Write(self, response, addrs):
+    """Sends response to clients, encoded once for each way they asked."""
+    for encoding, encoding_addrs in self._GroupByEncoding(addrs):
+      self._sock.Write(
+          response, encoding_addrs, encoding.packed, encoding.dictionary)
+
+  def _SendViewUpdate(self, addr, view, merged):
+    """Sends a client the blocks in its view.
+
+    Args:
+      merged: The changes since the tick the client ACKed, or None to send a
+          full update. Only changes within the view are sent, along with all
+          blocks in any part of the view the client may have forgotten.
+    """
+    latest = self._history[-1]
+    rect = view.Scroll(self._game, latest.size)
+    x0, y0, x1, y1 = rect
+    seen = None
+    if merged and not merged.full_update:
+      seen = view.GetSeenSince(merged.base_tick)
+    with self._phase_timer.Phase('view'):
+      if seen:
+        blocks = [
+            b for b in merged.block_update
+            if x0 <= b.pos.x < x1 and y0 <= b.pos.y < y1]
+        for exposed in _SubtractRect(rect, seen):
+          blocks.extend(self._game.GetBlocksInRect(*exposed))
+        response = self._MakeResponse(blocks, False, merged.base_tick)
+      else:
+        response = self._MakeResponse(
+            self._game.GetBlocksInRect(*rect), True)
+      response.view_origin.x = x0
+      response.view_origin.y = y0
+      response.view_size.x = x1 - x0
+      response.view_size.y = y1 - y0
+    view.Record(latest.tick, rect)
+    self._Write(response, [addr])
+
+  def _GetFullGameStateDatagrams(self, encoding):
+    """Encodes the full game state, only once for each new state."""
+    full_state = self._game.GetFullGameState()
+    if full_state is not self._encoded_full_state:
+      self._encoded_full_state = full_state
+      self._full_state_datagrams.clear()
+    datagrams = self._full_state_datagrams.get(encoding)
+    if datagrams is None:
+      datagrams = self._sock.Encode(
+          full_state, encoding.packed, encoding.dictionary)
+      self._full_state_datagrams[encoding] = datagrams
+    return datagrams
+
+  def _MergeHistorySince(self, base_tick):
+    """Returns a Response with all changes in history after base_tick."""
+    blocks_by_pos = {}
+    full_update = False
+    for response in self._history:
+      if response.tick <= base_tick:
+        continue
+      if response.full_update:
+        blocks_by_pos.clear()
+        full_update = True
+      for block in response.block_update:
+        blocks_by_pos[(block.pos.x, block.pos.y)] = block
+    return self._MakeResponse(
+        blocks_by_pos.values(), full_update,
+        None if full_update else base_tick)
+
+  def _MakeResponse(self, blocks, full_update, base_tick=None):
+    """Returns a Response with the latest state's tick, players and so on."""
+    latest = self._history[-1]
+    response = network_pb2.Response(
+        tick=latest.tick,
+        block_update=blocks,
+        full_update=full_update,
+        player_info=latest.player_info,
+        stage=latest.stage,
+        round_num=latest.round_num,
+        size=latest.size)
+    if latest.HasField('lives'):
+      response.lives = latest.lives
+    if base_tick is not None:
+      response.base_tick = base_tick
+    return response
 
   def _UnregisterInactiveClients(self):
     to_rm = []
@@ -264,15 +869,255 @@ class Server(object):
       del self._active_clients_by_addr[addr]
 
 
+
+def _MakeRoomSeed(seed, room_id):
+  """Returns an integer seed for a room's game, the same on any platform.
+
+  (Seeding with a string would go through hash(), which varies by build.)
+  """
+  digest = hashlib.sha1(
+      ('%s/%s' % (seed, room_id)).encode('utf-8')).hexdigest()
+  return int(digest[:16], 16)
+
+
+class Server(object):
+  """Hosts any number of games (rooms) on one UDP port.
+
+  Clients choose a room with the room_id in each Request. The default room,
+  with an empty room_id, always exists; others are made when a client first
+  registers in them and closed once they have been empty for a while.
+  """
+  _MAX_REQUESTS_PER_LOOP = 1000
+  _MAX_ROOMS = 64
+  _IDLE_ROOM_TIMEOUT = 60.0  # seconds
+  _IDLE_WAIT = 1.0  # longest to wait for requests, in seconds
+
+  def __init__(
+      self, host, port, width, height, mode, starting_round,
+      terrain_pool_size=0, profile_interval=0, keyframe_interval=5.0,
+      send_rate=60.0, max_rooms=_MAX_ROOMS, forwarded=False, dictionary=None,
+      seed=None, record_dir=None):
+    """Creates a server, with the given settings for each of its games.
+
+    Args:
+      send_rate: Most updates to send per second, if positive. Changes from
+          ticks in between are combined, so fast rounds don't send more.
+      keyframe_interval: Seconds between sending all clients a full update, if
+          positive. This bounds how long any client's view can stay wrong.
+      profile_interval: If positive, time each phase of the server loop and
+          log a summary at this interval in seconds.
+      max_rooms: Most games to host at once.
+      forwarded: Whether requests come through a sharding.Router, which
+          prefixes each with the client's address. Then there is no default
+          room until a client registers in it, and it may close like others.
+      dictionary: A compression.PresetDictionary to compress responses with,
+          for clients which have the same one.
+      seed: If given, each room's game is seeded with it and the room_id, so
+          that rooms of the same name get the same terrain and so on.
+      record_dir: If given, each room's game is recorded to a replay file in
+          this directory (see replay.Recorder).
+    """
+    if profile_interval > 0:
+      self._phase_timer = profiling.RollingPhaseTimer()
+    else:
+      self._phase_timer = profiling.NULL_TIMER
+    self._profile_interval = profile_interval
+    self._last_profile_time = time.time()
+    self._num_loops = 0
+    self._num_overruns = 0
+    self._num_requests = 0
+    self._logged_room_stats = {}  # room_id: (num_ticks, busy_seconds)
+    self._running = True
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((host, port))
+    self._sock = _ProtoSocket(
+        s, network_pb2.Request, phase_timer=self._phase_timer,
+        forwarded=forwarded)
+    self.port = s.getsockname()[1]
+    logging.info('Listening on %s:%d.', host, self.port)
+
+    self._room_args = (
+        width, height, mode, starting_round, terrain_pool_size,
+        keyframe_interval, send_rate, dictionary, seed, record_dir)
+    self._max_rooms = max_rooms
+    self._rooms_by_id = collections.OrderedDict()
+    self._keep_default_room = not forwarded
+    if self._keep_default_room:
+      self._MakeRoom('')
+
+  def _MakeRoom(self, room_id):
+    (width, height, mode, starting_round, terrain_pool_size,
+     keyframe_interval, send_rate, dictionary, seed,
+     record_dir) = self._room_args
+    game = controller.Controller(
+        width, height, mode, starting_round, terrain_pool_size,
+        phase_timer=self._phase_timer,
+        seed=None if seed is None else _MakeRoomSeed(seed, room_id))
+    recorder = None
+    if record_dir:
+      recorder = replay.Recorder(
+          os.path.join(record_dir, '%s-%s.replay' % (
+              re.sub(r'[^\w-]', '_', room_id) or 'default',
+              time.strftime('%Y%m%d-%H%M%S'))),
+          room_id)
+      logging.info('Recording room %r to %s.', room_id, recorder.path)
+    room = _Room(
+        room_id, self._sock, game, self._phase_timer, keyframe_interval,
+        send_rate, record_input=self._profile_interval > 0,
+        dictionary=dictionary, recorder=recorder)
+    self._rooms_by_id[room_id] = room
+    logging.info('Opened room %r (%d rooms).', room_id, len(self._rooms_by_id))
+    return room
+
+  def ListenAndUpdateForever(self):
+    """Handles requests as they arrive, and updates each game on schedule."""
+    try:
+      while self._running:
+        wake_time = min(
+            [room.GetWakeTime() for room in self._rooms_by_id.itervalues()] +
+            [time.time() + self._IDLE_WAIT])
+        timeout = max(0.0, wake_time - time.time())
+        readable = self._WaitForRequests(timeout)
+        t = time.time()
+        if readable:
+          with self._phase_timer.Phase('read'):
+            self._ReadClientRequests()
+        self._UpdateRooms()
+        self._num_loops += 1
+        if time.time() - t > _UPDATE_INTERVAL:
+          self._num_overruns += 1
+        if (self._profile_interval > 0 and
+            t - self._last_profile_time >= self._profile_interval):
+          self._LogProfile(t)
+    except KeyboardInterrupt:
+      pass
+    finally:
+      logging.info('Closing listening socket.')
+      self._sock.Close()
+      for room in self._rooms_by_id.itervalues():
+        room.Close()
+
+  def _WaitForRequests(self, timeout):
+    """Returns whether requests arrived within timeout seconds."""
+    readable, _, _ = select.select([self._sock], [], [], timeout)
+    return bool(readable)
+
+  def _UpdateRooms(self):
+    """Updates every room, starting from a different one each time.
+
+    Rooms which fall behind are each limited in how many ticks they catch up
+    at once, so rotating the order keeps any one room from always waiting on
+    all the others.
+    """
+    rooms = self._rooms_by_id.values()
+    first = self._num_loops % max(1, len(rooms))
+    for room in rooms[first:] + rooms[:first]:
+      room.Update()
+      if ((room.room_id or not self._keep_default_room) and
+          room.IsIdle(self._IDLE_ROOM_TIMEOUT)):
+        self._CloseRoom(room)
+
+  def _CloseRoom(self, room):
+    logging.info('Closing idle room %r.', room.room_id)
+    room.Close()
+    del self._rooms_by_id[room.room_id]
+    self._logged_room_stats.pop(room.room_id, None)
+
+  def _LogProfile(self, t):
+    dt = t - self._last_profile_time
+    room_lines = []
+    for room in self._rooms_by_id.itervalues():
+      logged_ticks, logged_seconds = self._logged_room_stats.get(
+          room.room_id, (0, 0.0))
+      num_ticks = room.num_ticks - logged_ticks
+      busy_seconds = room.busy_seconds - logged_seconds
+      room_lines.append(
+          'room %-12s %5d ticks %7.2fms/tick %5.1f%% busy %d skipped' % (
+              room.room_id or '(default)',
+              num_ticks,
+              1000 * busy_seconds / max(1, num_ticks),
+              100 * busy_seconds / dt,
+              room.num_skipped_ticks))
+      self._logged_room_stats[room.room_id] = (
+          room.num_ticks, room.busy_seconds)
+    logging.info(
+        '%d of %d loops in %.1fs overran %.1fms. '
+        'Read %d requests. Sent %d bytes, encoded %d. Rooms:\n%s\nPhases:\n%s',
+        self._num_overruns,
+        self._num_loops,
+        dt,
+        1000 * _UPDATE_INTERVAL,
+        self._num_requests,
+        self._sock.bytes_sent,
+        self._sock.bytes_encoded,
+        '\n'.join(room_lines),
+        self._phase_timer.FormatSummary())
+    self._phase_timer.Reset()
+    self._last_profile_time = t
+    self._num_loops = 0
+    self._num_overruns = 0
+    self._num_requests = 0
+
+  def _ReadClientRequests(self):
+    for request, client_addr in self._sock.ReadBatch(
+        self._MAX_REQUESTS_PER_LOOP):
+      self._num_requests += 1
+      logging.debug(
+          'Client %s:%d sends: %s',
+          client_addr[0], client_addr[1], str(request).replace('\n', ' '))
+      if not request.HasField('command'):
+        logging.error('Ignoring empty request!')
+        continue
+      room = self._rooms_by_id.get(request.room_id)
+      if not room:
+        if request.command != network_pb2.Request.REGISTER:
+          logging.warning(
+              'Ignoring request for unknown room %r.', request.room_id)
+          continue
+        if len(self._rooms_by_id) >= self._max_rooms:
+          logging.error(
+              'Not opening room %r, already at the limit of %d rooms.',
+              request.room_id, self._max_rooms)
+          continue
+        room = self._MakeRoom(request.room_id)
+      room.HandleRequest(request, client_addr)
+
+
 class Client(object):
-  def __init__(self, host, port):
+  _MAX_DATAGRAMS_PER_UPDATE = 1000
+
+  def __init__(
+      self, host, port, room_id='', packed_blocks=False, dictionary=None):
+    """Connects to a server.
+
+    Args:
+      packed_blocks: Whether to ask for blocks packed with block_codec, which
+          is several times smaller on the wire but slower to decode.
+      dictionary: A compression.PresetDictionary for the server to compress
+          responses with, if it has the same one.
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    self._sock = _ProtoSocket(sock, network_pb2.Response, (host, port))
+    self._sock = _ProtoSocket(
+        sock, network_pb2.Response, (host, port), dictionary=dictionary)
+    self._room_id = room_id
+    self._packed_blocks = packed_blocks
+    self._dictionary = dictionary
+    self._ack_secret = None
+    self._applied_tick = None
+
+  def _WriteRequest(self, secret, command, **fields):
+    self._sock.Write(network_pb2.Request(
+        secret=secret, command=command, room_id=self._room_id, **fields))
 
   def Register(self, secret, name):
-    register_req = network_pb2.Request(
-        secret=secret, command=network_pb2.Request.REGISTER, name=name)
-    self._sock.Write(register_req)
+    fields = {}
+    if self._dictionary:
+      fields['dictionary_id'] = self._dictionary.dict_id
+    self._WriteRequest(
+        secret, network_pb2.Request.REGISTER, name=name,
+        packed_blocks=self._packed_blocks, **fields)
+    self._ack_secret = self._ack_secret or secret
     try:
       resp, unused_sender_addr = self._sock.ReadBlocking()
       while not resp.HasField('player_id'):
@@ -287,29 +1132,58 @@ class Client(object):
     return resp.player_id
 
   def Move(self, secret, direction):
-    self._sock.Write(network_pb2.Request(
-        secret=secret, command=network_pb2.Request.MOVE, direction=direction))
+    self._WriteRequest(secret, network_pb2.Request.MOVE, direction=direction)
 
   def Action(self, secret):
-    self._sock.Write(network_pb2.Request(
-        secret=secret, command=network_pb2.Request.ACTION))
+    self._WriteRequest(secret, network_pb2.Request.ACTION)
 
   def GetUpdates(self):
+    """Returns new updates which apply to the state so far, and ACKs them."""
     updates = []
-    resp, unused_sender_addr = self._sock.Read()
-    while resp:
-      updates.append(resp)
-      resp, unused_sender_addr = self._sock.Read()
+    for resp, unused_sender_addr in self._sock.ReadBatch(
+        self._MAX_DATAGRAMS_PER_UPDATE):
+      if self._Applies(resp):
+        updates.append(resp)
+        self._applied_tick = resp.tick
+    if updates and self._ack_secret:
+      self._WriteRequest(
+          self._ack_secret,
+          network_pb2.Request.ACK,
+          ack_tick=self._applied_tick)
     return updates
 
+  def RequestFullUpdate(self, view_size=None):
+    """Asks for a full update, ignoring other updates until it arrives.
+
+    Args:
+      view_size: If given, a Coordinate size of window to be sent only the
+          blocks within from now on, following the first registered player.
+    """
+    if self._ack_secret:
+      self._applied_tick = None
+      self._WriteRequest(
+          self._ack_secret, network_pb2.Request.RESYNC, view_size=view_size)
+
+  def _Applies(self, resp):
+    if not resp.HasField('tick'):
+      return True
+    if self._applied_tick is not None and resp.tick <= self._applied_tick:
+      return False  # reordered or duplicate
+    if resp.full_update or not resp.HasField('base_tick'):
+      return True
+    # Changes since base_tick also bring any later state up to date.
+    return (
+        self._applied_tick is not None and
+        self._applied_tick >= resp.base_tick)
+
   def Unregister(self, secret):
-    self._sock.Write(network_pb2.Request(
-        secret=secret, command=network_pb2.Request.UNREGISTER))
+    self._WriteRequest(secret, network_pb2.Request.UNREGISTER)
 
 
 class LocalThreadClient(threading.Thread):
-  def __init__(self, width, height, mode, round):
-    self._controller = controller.Controller(width, height, mode, round)
+  def __init__(self, width, height, mode, round, seed=None):
+    self._controller = controller.Controller(
+        width, height, mode, round, seed=seed)
     self._last_state_hash = None
     self._last_state = None
     self._lock = threading.Lock()
@@ -335,9 +1209,14 @@ class LocalThreadClient(threading.Thread):
     with self._lock:
       return [self._last_state]
 
+  def RequestFullUpdate(self, unused_view_size=None):
+    """Sends the whole world next, since there is no network to save."""
+    with self._lock:
+      if self._last_state:
+        self._last_state = self._controller.GetFullGameState()
+
   def run(self):
     while True:
-      t = time.time()
       with self._lock:
         new_state = None
         if self._controller.Update():
@@ -345,6 +1224,5 @@ class LocalThreadClient(threading.Thread):
               self._last_state_hash)
         if new_state:
           self._last_state = new_state
-      used_dt = time.time() - t
-      if used_dt < _UPDATE_INTERVAL:
-        time.sleep(_UPDATE_INTERVAL - used_dt)
+        next_update_time = self._controller.GetNextUpdateTime()
+      time.sleep(max(0.0, next_update_time - time.time()))
@@ -0,0 +1,96 @@
+"""Timing of named phases of work, such as the parts of a game tick.
+
+Code under measurement wraps each phase in `with timer.Phase('name'):`. When no
+profiling is wanted, NULL_TIMER makes that a no-op without allocation.
+"""
+
+import collections
+import time
+
+
+class PhaseTimer(object):
+  """Accumulates total wall time and call counts per phase name."""
+  def __init__(self):
+    self.seconds_by_phase = collections.defaultdict(float)
+    self.counts_by_phase = collections.defaultdict(int)
+
+  def Phase(self, name):
+    return _TimedPhase(self, name)
+
+  def Reset(self):
+    self.seconds_by_phase.clear()
+    self.counts_by_phase.clear()
+
+  def Record(self, name, seconds):
+    self.seconds_by_phase[name] += seconds
+    self.counts_by_phase[name] += 1
+
+
+class RollingPhaseTimer(PhaseTimer):
+  """Also keeps the most recent samples of each phase, for percentiles."""
+  def __init__(self, window=1000):
+    PhaseTimer.__init__(self)
+    self.samples_by_phase = collections.defaultdict(
+        lambda: collections.deque(maxlen=window))
+
+  def Reset(self):
+    PhaseTimer.Reset(self)
+    self.samples_by_phase.clear()
+
+  def Record(self, name, seconds):
+    PhaseTimer.Record(self, name, seconds)
+    self.samples_by_phase[name].append(seconds)
+
+  def Percentiles(self, name, percentiles=(50, 99, 100)):
+    """Returns seconds at each percentile of the phase's recent samples."""
+    samples = sorted(self.samples_by_phase[name])
+    if not samples:
+      return [0.0] * len(percentiles)
+    return [
+        samples[min(len(samples) - 1, len(samples) * p / 100)]
+        for p in percentiles]
+
+  def FormatSummary(self):
+    """Returns a line of p50/p99/max milliseconds for each phase."""
+    lines = []
+    for name in sorted(self.samples_by_phase):
+      lines.append('%-12s p50 %7.2fms p99 %7.2fms max %7.2fms (%d calls)' % (
+          (name,) +
+          tuple(1000 * s for s in self.Percentiles(name)) +
+          (self.counts_by_phase[name],)))
+    return '\n'.join(lines)
+
+
+class _TimedPhase(object):
+  __slots__ = ('_timer', '_name', '_start')
+
+  def __init__(self, timer, name):
+    self._timer = timer
+    self._name = name
+
+  def __enter__(self):
+    self._start = time.time()
+
+  def __exit__(self, *unused_exc_info):
+    self._timer.Record(self._name, time.time() - self._start)
+
+
+class _NullPhase(object):
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *unused_exc_info):
+    pass
+
+
+class _NullPhaseTimer(object):
+  _PHASE = _NullPhase()
+
+  def Phase(self, unused_name):
+    return self._PHASE
+
+  def Record(self, unused_name, unused_seconds):
+    pass
+
+
+NULL_TIMER = _NullPhaseTimer()
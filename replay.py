@@ -0,0 +1,345 @@
+"""Recording of games to replay files, and reading them back by tick.
+
+A replay file is a sequence of length-prefixed ReplayRecords (see
+replay.proto): a header, then the requests and updates of a game as they
+happened, with a keyframe of the full state every so many ticks. A file closed
+cleanly ends with an index of the keyframes, with the first for each interval
+of ticks, and a trailer pointing to it, so seeking to a tick reads one index
+entry and then replays at most about an interval of updates. Files without an
+index, for example from a server which crashed, are scanned to make one.
+"""
+
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+from common import game_pb2, network_pb2, replay_pb2
+
+
+_KEYFRAME_INTERVAL = 600  # ticks
+_LENGTH = struct.Struct('<I')
+# Last in a cleanly closed file: the offset of the index record, and a magic
+# string to recognize it by.
+_TRAILER = struct.Struct('<Q8s')
+_TRAILER_MAGIC = 'NSREPIDX'
+
+
+class _Model(object):
+  """The latest state of a game, kept up to date by applying its updates."""
+  def __init__(self):
+    self._blocks_by_pos = {}
+    self._latest = None
+
+  @property
+  def has_state(self):
+    return self._latest is not None
+
+  def Apply(self, update):
+    if update.full_update:
+      self._blocks_by_pos.clear()
+    for block in update.block_update:
+      pos = (block.pos.x, block.pos.y)
+      if block.type == game_pb2.Block.EMPTY:
+        self._blocks_by_pos.pop(pos, None)
+      else:
+        self._blocks_by_pos[pos] = block
+    self._latest = update
+
+  def MakeFullUpdate(self):
+    """Returns the state as of the last update applied, as a full update."""
+    state = network_pb2.Response()
+    state.CopyFrom(self._latest)
+    state.ClearField('block_update')
+    state.ClearField('base_tick')
+    state.full_update = True
+    state.block_update.extend(
+        self._blocks_by_pos[pos] for pos in sorted(self._blocks_by_pos))
+    return state
+
+
+def _MakeIndex(keyframes, last_tick, interval):
+  """Returns a ReplayIndex given the (tick, offset) of each keyframe."""
+  index = replay_pb2.ReplayIndex()
+  if not keyframes:
+    return index
+  for tick, offset in keyframes:
+    index.keyframe_tick.append(tick)
+    index.keyframe_offset.append(offset)
+  i = 0
+  for start_tick in xrange(0, last_tick + 1, interval):
+    while i < len(keyframes) and keyframes[i][0] < start_tick:
+      i += 1
+    index.interval_keyframe.append(i)
+  return index
+
+
+def _GetKeyframe(record):
+  """Returns the full state in a record, if any, else None."""
+  if record.HasField('keyframe'):
+    return record.keyframe
+  if record.HasField('update') and record.update.full_update:
+    return record.update
+  return None
+
+
+class Recorder(object):
+  """Writes a game's requests and updates to a replay file.
+
+  Recording only queues what is given, along with the time. A background
+  thread serializes and writes it, makes keyframes, and flushes the file every
+  so often, so that recording adds little to the game's update loop.
+  """
+  _FLUSH_INTERVAL = 1.0  # seconds
+
+  def __init__(self, path, room_id='', keyframe_interval=_KEYFRAME_INTERVAL):
+    self.path = path
+    self._file = open(path, 'wb')
+    self._start_time = time.time()
+    self._keyframe_interval = keyframe_interval
+    self._queue = collections.deque()
+    self._closing = threading.Event()
+    self._failed = False
+
+    # used only by the writing thread (after the header)
+    self._model = _Model()
+    self._keyframes = []  # (tick, offset)
+    self._next_keyframe_tick = 0
+    self._last_tick = 0
+
+    self._Write(replay_pb2.ReplayRecord(header=replay_pb2.ReplayHeader(
+        room_id=room_id,
+        start_time=self._start_time,
+        keyframe_interval=keyframe_interval)))
+    self._thread = threading.Thread(target=self._WriteQueuedUntilClosed)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def RecordRequest(self, tick, player_id, request):
+    """Queues a request to record, which must not be changed afterwards.
+
+    Args:
+      tick: The game's tick when the request arrived.
+      player_id: The player the request's secret is for, if any. The secret
+          itself is recorded as empty.
+    """
+    if not self._failed:
+      self._queue.append(
+          (self._WriteRequest, time.time(), tick, player_id, request))
+
+  def RecordUpdate(self, update):
+    """Queues a game update to record, which must not be changed afterwards."""
+    if not self._failed:
+      self._queue.append((self._WriteUpdate, time.time(), update))
+
+  def Close(self):
+    """Writes everything queued, and the index."""
+    self._closing.set()
+    self._thread.join()
+    if not self._failed:
+      index_offset = self._file.tell()
+      self._Write(replay_pb2.ReplayRecord(index=_MakeIndex(
+          self._keyframes, self._last_tick, self._keyframe_interval)))
+      self._file.write(_TRAILER.pack(index_offset, _TRAILER_MAGIC))
+    self._file.close()
+    logging.info('Closed replay %s.', self.path)
+
+  def _WriteQueuedUntilClosed(self):
+    while not self._failed:
+      closing = self._closing.wait(self._FLUSH_INTERVAL)
+      try:
+        while self._queue:
+          item = self._queue.popleft()
+          item[0](*item[1:])
+        self._file.flush()
+      except IOError, e:
+        logging.error('Stopped recording to %s: %s', self.path, e)
+        self._failed = True
+        self._queue.clear()
+      if closing:
+        break
+
+  def _Write(self, record):
+    data = record.SerializeToString()
+    self._file.write(_LENGTH.pack(len(data)))
+    self._file.write(data)
+
+  def _WriteRequest(self, t, tick, player_id, request):
+    recorded = replay_pb2.RecordedRequest(tick=tick, request=request)
+    recorded.request.secret = ''
+    if player_id is not None:
+      recorded.player_id = player_id
+    self._Write(replay_pb2.ReplayRecord(
+        time=t - self._start_time, request=recorded))
+
+  def _WriteUpdate(self, t, update):
+    self._model.Apply(update)
+    self._last_tick = update.tick
+    offset = self._file.tell()
+    self._Write(replay_pb2.ReplayRecord(
+        time=t - self._start_time, update=update))
+    if update.full_update:
+      pass  # its own keyframe, as the scan for an index would also find
+    elif update.tick >= self._next_keyframe_tick:
+      offset = self._file.tell()
+      self._Write(replay_pb2.ReplayRecord(
+          time=t - self._start_time, keyframe=self._model.MakeFullUpdate()))
+    else:
+      return
+    self._keyframes.append((update.tick, offset))
+    self._next_keyframe_tick = (
+        update.tick / self._keyframe_interval + 1) * self._keyframe_interval
+
+
+class Reader(object):
+  """Reads a replay file, seeking to ticks by its keyframe index."""
+  def __init__(self, path):
+    self._file = open(path, 'rb')
+    record, self._first_offset = self._ReadAt(0)
+    if not record or not record.HasField('header'):
+      raise ValueError('%s is not a replay file.' % path)
+    self.header = record.header
+    self._index = self._ReadIndex()
+    if self._index is None:
+      logging.info('%s has no index, so scanning it to make one.', path)
+      self._index = self._ScanForIndex()
+
+  @property
+  def num_keyframes(self):
+    return len(self._index.keyframe_offset)
+
+  def _ReadAt(self, offset):
+    """Returns the record at offset and the offset after it.
+
+    The record is None at the end of the records, including at a record which
+    is cut short, as if still being written.
+    """
+    self._file.seek(offset)
+    length_data = self._file.read(_LENGTH.size)
+    if len(length_data) < _LENGTH.size:
+      return None, offset
+    length, = _LENGTH.unpack(length_data)
+    data = self._file.read(length)
+    if len(data) < length:
+      return None, offset
+    record = replay_pb2.ReplayRecord.FromString(data)
+    if record.HasField('index'):
+      return None, offset
+    return record, offset + _LENGTH.size + length
+
+  def _ReadIndex(self):
+    self._file.seek(0, os.SEEK_END)
+    size = self._file.tell()
+    if size < _TRAILER.size:
+      return None
+    self._file.seek(size - _TRAILER.size)
+    index_offset, magic = _TRAILER.unpack(self._file.read(_TRAILER.size))
+    if magic != _TRAILER_MAGIC:
+      return None
+    self._file.seek(index_offset)
+    length, = _LENGTH.unpack(self._file.read(_LENGTH.size))
+    return replay_pb2.ReplayRecord.FromString(self._file.read(length)).index
+
+  def _ScanForIndex(self):
+    keyframes = []
+    last_tick = 0
+    for offset, record in self.IterRecords():
+      keyframe = _GetKeyframe(record)
+      if keyframe:
+        keyframes.append((keyframe.tick, offset))
+      if record.HasField('update'):
+        last_tick = record.update.tick
+    return _MakeIndex(keyframes, last_tick, self.header.keyframe_interval)
+
+  def IterRecords(self, offset=None):
+    """Yields (offset, record) for each record after the header, in order."""
+    if offset is None:
+      offset = self._first_offset
+    while True:
+      record, next_offset = self._ReadAt(offset)
+      if not record:
+        return
+      yield offset, record
+      offset = next_offset
+
+  def Seek(self, tick):
+    """Returns the game as of tick, from its keyframe before and the updates.
+
+    Returns:
+      The full state and time of the last update at or before tick (or the
+      first update, for earlier ticks), and the offset of the records after
+      it, or None past the end. The state is None if there are no updates.
+    """
+    if not self._index.keyframe_offset:
+      return None, None, None
+    interval_keyframe = self._index.interval_keyframe
+    i = interval_keyframe[max(0, min(
+        tick / self.header.keyframe_interval, len(interval_keyframe) - 1))]
+    # The interval's first keyframe, unless it is after tick, as the
+    # recorder's keyframe on the interval boundary usually is a bit.
+    if i == len(self._index.keyframe_tick) or (
+        self._index.keyframe_tick[i] > tick):
+      i = max(0, i - 1)
+    record, offset = self._ReadAt(self._index.keyframe_offset[i])
+    model = _Model()
+    model.Apply(_GetKeyframe(record))
+    state_time = record.time
+    for offset, record in self.IterRecords(offset):
+      if record.HasField('update'):
+        if record.update.tick > tick:
+          break
+        model.Apply(record.update)
+        state_time = record.time
+    else:
+      offset = None
+    return model.MakeFullUpdate(), state_time, offset
+
+  def IterUpdates(self, start_tick=0):
+    """Yields (time, update) from start_tick, starting with a full update."""
+    state, state_time, offset = self.Seek(start_tick)
+    if not state:
+      return
+    yield state_time, state
+    if offset is None:
+      return
+    for _, record in self.IterRecords(offset):
+      if record.HasField('update'):
+        yield record.time, record.update
+
+
+class PlaybackServer(object):
+  """Plays a replay to a client.Client, in place of a game server.
+
+  Updates are given at the pace they were recorded, times speed. The client
+  should have no players, since there is no game to send commands to.
+  """
+  def __init__(self, reader, start_tick=0, speed=1.0):
+    self._updates = reader.IterUpdates(start_tick)
+    self._speed = speed
+    self._model = _Model()
+    self._next = next(self._updates, None)
+    self._playback_start = None  # (time.time(), recorded time) at the start
+    self._full_update_requested = False
+
+  def GetUpdates(self):
+    t = time.time()
+    updates = []
+    while self._next:
+      record_time, update = self._next
+      if self._playback_start is None:
+        self._playback_start = (t, record_time)
+      start_time, start_record_time = self._playback_start
+      if (record_time - start_record_time) / self._speed > t - start_time:
+        break
+      self._model.Apply(update)
+      updates.append(update)
+      self._next = next(self._updates, None)
+    if self._full_update_requested and self._model.has_state:
+      self._full_update_requested = False
+      return [self._model.MakeFullUpdate()]
+    return updates
+
+  def RequestFullUpdate(self, unused_view_size=None):
+    self._full_update_requested = True
@@ -0,0 +1,74 @@
+"""Rockets, stored as parallel lists so they move and expire in batches.
+
+A nuke or a chain of mine explosions adds rockets by the hundred, so rather than
+a Block proto per rocket, each attribute is a list indexed by rocket number.
+Blocks are only made when needed, for collisions and for client updates.
+"""
+
+import itertools
+
+from common import game_pb2
+
+
+_B = game_pb2.Block
+_FIELDS = ('xs', 'ys', 'dxs', 'dys', 'player_ids', 'last_viable_ticks')
+_KILLED = -1  # last viable tick for rockets to be removed at the next Expire
+
+
+class Rockets(object):
+  def __init__(self, width, height):
+    self._width = width
+    self._height = height
+    self.Clear()
+
+  def Clear(self):
+    for field in _FIELDS:
+      setattr(self, field, [])
+
+  def __len__(self):
+    return len(self.xs)
+
+  def Add(self, x, y, dx, dy, player_id, last_viable_tick):
+    self.xs.append(x)
+    self.ys.append(y)
+    self.dxs.append(dx)
+    self.dys.append(dy)
+    self.player_ids.append(player_id)
+    self.last_viable_ticks.append(last_viable_tick)
+
+  def Advance(self):
+    """Moves every rocket one step in its direction, wrapping around."""
+    w = self._width
+    h = self._height
+    self.xs = [(x + dx) % w for x, dx in itertools.izip(self.xs, self.dxs)]
+    self.ys = [(y + dy) % h for y, dy in itertools.izip(self.ys, self.dys)]
+
+  def Kill(self, i):
+    """Flags a rocket for removal at the next Expire, keeping indices stable."""
+    self.last_viable_ticks[i] = _KILLED
+
+  def Expire(self, tick):
+    """Removes rockets past their last viable tick.
+
+    Returns:
+      A list of (x, y) positions the removed rockets were at.
+    """
+    keep = [i for i, t in enumerate(self.last_viable_ticks) if t >= tick]
+    if len(keep) == len(self.xs):
+      return []
+    removed = [
+        (x, y) for x, y, t in itertools.izip(
+            self.xs, self.ys, self.last_viable_ticks)
+        if t < tick]
+    for field in _FIELDS:
+      values = getattr(self, field)
+      setattr(self, field, [values[i] for i in keep])
+    return removed
+
+  def MakeBlock(self, i):
+    return _B(
+        type=_B.ROCKET,
+        pos=game_pb2.Coordinate(x=self.xs[i], y=self.ys[i]),
+        direction=game_pb2.Coordinate(x=self.dxs[i], y=self.dys[i]),
+        last_viable_tick=max(0, self.last_viable_ticks[i]),
+        player_id=self.player_ids[i])
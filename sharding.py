@@ -0,0 +1,283 @@
+"""Runs rooms in a pool of worker processes, to use more than one core.
+
+A Router owns the public port. It reads only the room_id of each request, and
+forwards the datagram to the worker process hosting that room, prefixed with
+the client's address. Each worker is a network.Server on its own local port,
+and sends its responses straight to clients rather than back through the
+Router. (Clients accept responses from any address, but this means the
+workers' ports must be reachable too, as for clients behind a NAT.)
+
+New rooms are placed on the worker which measured the least tick cost. To take
+a worker out of the pool, for example to restart it with new code, send it
+SIGUSR1: it stops being given new rooms, and exits once its rooms have all
+emptied and closed. Then the Router starts a replacement.
+"""
+import logging
+import multiprocessing
+import select
+import signal
+import socket
+import time
+import zlib
+
+from common import network_pb2, message
+import network
+
+
+class _WorkerServer(network.Server):
+  """Hosts rooms for a Router, and reports their cost over a pipe.
+
+  Messages sent to the Router are tuples:
+    ('ready', port)
+    ('load', {room_id: fraction of the time busy running the room})
+    ('closed', room_id)
+    ('draining',)
+  The Router sends ('stop',) when shutting down.
+  """
+  _REPORT_INTERVAL = 1.0  # seconds
+
+  def __init__(self, conn, *args, **kwargs):
+    network.Server.__init__(self, *args, forwarded=True, **kwargs)
+    self._conn = conn
+    self._draining = False
+    self._reported_draining = False
+    self._last_report_time = time.time()
+    self._reported_busy_seconds = {}
+    signal.signal(signal.SIGUSR1, self._StartDraining)
+
+  def _StartDraining(self, unused_signum, unused_frame):
+    self._draining = True
+
+  def _WaitForRequests(self, timeout):
+    try:
+      readable, _, _ = select.select([self._sock, self._conn], [], [], timeout)
+    except select.error:
+      return False  # interrupted by a signal
+    if self._conn in readable:
+      try:
+        msg = self._conn.recv()
+      except (EOFError, IOError):
+        msg = ('stop',)  # the Router exited
+      if msg[0] == 'stop':
+        self._running = False
+    return self._sock in readable
+
+  def _SendToRouter(self, msg):
+    try:
+      self._conn.send(msg)
+    except IOError:
+      self._running = False  # the Router exited
+
+  def _UpdateRooms(self):
+    network.Server._UpdateRooms(self)
+    t = time.time()
+    if t - self._last_report_time >= self._REPORT_INTERVAL:
+      self._ReportLoad(t)
+    if self._draining and not self._reported_draining:
+      self._SendToRouter(('draining',))
+      self._reported_draining = True
+    if self._draining and not self._rooms_by_id:
+      logging.info('Worker drained, exiting.')
+      self._running = False
+
+  def _CloseRoom(self, room):
+    network.Server._CloseRoom(self, room)
+    self._reported_busy_seconds.pop(room.room_id, None)
+    self._SendToRouter(('closed', room.room_id))
+
+  def _ReportLoad(self, t):
+    dt = t - self._last_report_time
+    load_by_room_id = {}
+    for room_id, room in self._rooms_by_id.iteritems():
+      busy_seconds = room.busy_seconds - self._reported_busy_seconds.get(
+          room_id, 0.0)
+      load_by_room_id[room_id] = busy_seconds / dt
+      self._reported_busy_seconds[room_id] = room.busy_seconds
+    self._SendToRouter(('load', load_by_room_id))
+    self._last_report_time = t
+
+
+def _RunWorker(conn, router_conns, host, server_args, server_kwargs):
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # The Router stops workers.
+  # Close the copies of the Router's ends of pipes made by forking, so that
+  # each worker sees its pipe close if the Router exits, and vice versa.
+  for router_conn in router_conns:
+    router_conn.close()
+  server = _WorkerServer(conn, host, 0, *server_args, **server_kwargs)
+  conn.send(('ready', server.port))
+  server.ListenAndUpdateForever()
+
+
+class _Worker(object):
+  """The Router's view of one worker process."""
+  def __init__(self, process, conn):
+    self.process = process
+    self.conn = conn
+    self.port = None  # set once the worker is ready
+    self.draining = False
+    self.room_ids = set()
+    self.load_by_room_id = {}
+
+  def EstimateLoad(self, room_load):
+    """Returns the total load, counting rooms not yet measured as room_load."""
+    return sum(self.load_by_room_id.get(room_id, room_load)
+               for room_id in self.room_ids)
+
+
+class Router(object):
+  """Forwards client requests on a public port to rooms in worker processes."""
+  _MAX_REQUESTS_PER_LOOP = 1000
+  _BUFFER_SIZE = 9214
+  _WORKER_CHECK_INTERVAL = 1.0  # seconds between checking workers are alive
+  _WORKER_STOP_TIMEOUT = 5.0  # seconds to wait for a worker to stop
+
+  def __init__(self, host, port, num_workers, *server_args, **server_kwargs):
+    """Starts num_workers processes, each a network.Server with the args."""
+    self._host = host
+    self._server_args = server_args
+    self._server_kwargs = server_kwargs
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._sock.bind((host, port))
+    self._sock.setblocking(False)
+    self._forward_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    logging.info('Listening on %s:%d.', host, port)
+
+    self._workers = []
+    self._worker_by_room_id = {}
+    for _ in xrange(num_workers):
+      self._StartWorker()
+
+  def _StartWorker(self):
+    conn, worker_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_RunWorker,
+        args=(
+            worker_conn, [conn] + [worker.conn for worker in self._workers],
+            self._host, self._server_args, self._server_kwargs))
+    # Not a daemon, since a worker's games may start terrain pool processes
+    # of their own. The Router stops its workers in Close.
+    process.start()
+    worker_conn.close()
+    self._workers.append(_Worker(process, conn))
+    logging.info('Started worker process %d.', process.pid)
+
+  def ListenAndForwardForever(self):
+    try:
+      while True:
+        readable, _, _ = select.select(
+            [self._sock] + [worker.conn for worker in self._workers], [], [],
+            self._WORKER_CHECK_INTERVAL)
+        for worker in list(self._workers):
+          if worker.conn in readable:
+            self._ReadWorkerMessages(worker)
+          elif not worker.process.is_alive():
+            self._RemoveWorker(worker)
+        if self._sock in readable:
+          self._ForwardClientRequests()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      self.Close()
+
+  def Close(self):
+    """Closes the listening socket, and stops the workers."""
+    logging.info('Closing listening socket and stopping workers.')
+    self._sock.close()
+    for worker in self._workers:
+      try:
+        worker.conn.send(('stop',))
+      except IOError:
+        pass  # already exited
+    for worker in self._workers:
+      worker.process.join(self._WORKER_STOP_TIMEOUT)
+      if worker.process.is_alive():
+        logging.warning(
+            'Worker %d did not stop, terminating it.', worker.process.pid)
+        worker.process.terminate()
+        worker.process.join()
+
+  def _ReadWorkerMessages(self, worker):
+    try:
+      while worker.conn.poll():
+        self._HandleWorkerMessage(worker, worker.conn.recv())
+    except (EOFError, IOError):
+      self._RemoveWorker(worker)
+
+  def _HandleWorkerMessage(self, worker, msg):
+    if msg[0] == 'ready':
+      worker.port = msg[1]
+      logging.info(
+          'Worker %d is ready on port %d.', worker.process.pid, worker.port)
+    elif msg[0] == 'load':
+      worker.load_by_room_id = msg[1]
+    elif msg[0] == 'closed':
+      worker.room_ids.discard(msg[1])
+      worker.load_by_room_id.pop(msg[1], None)
+      if self._worker_by_room_id.get(msg[1]) is worker:
+        del self._worker_by_room_id[msg[1]]
+    elif msg[0] == 'draining':
+      if not worker.draining:
+        logging.info(
+            'Draining worker %d, with %d rooms.',
+            worker.process.pid, len(worker.room_ids))
+        worker.draining = True
+    else:
+      logging.error('Ignoring unrecognized worker message: %r', msg)
+
+  def _RemoveWorker(self, worker):
+    worker.process.join()
+    self._workers.remove(worker)
+    for room_id in worker.room_ids:
+      if self._worker_by_room_id.get(room_id) is worker:
+        del self._worker_by_room_id[room_id]
+    if worker.draining:
+      logging.info('Worker %d drained, replacing it.', worker.process.pid)
+    else:
+      logging.error(
+          'Worker %d exited with code %s, losing %d rooms. Replacing it.',
+          worker.process.pid, worker.process.exitcode, len(worker.room_ids))
+    self._StartWorker()
+
+  def _ForwardClientRequests(self):
+    for _ in xrange(self._MAX_REQUESTS_PER_LOOP):
+      try:
+        data, client_addr = self._sock.recvfrom(self._BUFFER_SIZE)
+      except socket.error:
+        break  # no data right now
+      try:
+        request = network_pb2.Request.FromString(zlib.decompress(data))
+      except (zlib.error, message.DecodeError):
+        logging.error(
+            'Decoding error of %d bytes from %s:%d.',
+            len(data), client_addr[0], client_addr[1])
+        continue
+      worker = self._worker_by_room_id.get(request.room_id)
+      if not worker:
+        if request.command != network_pb2.Request.REGISTER:
+          continue  # The worker will be the one to log unexpected requests.
+        worker = self._PlaceRoom(request.room_id)
+        if not worker:
+          logging.error('No worker ready for room %r.', request.room_id)
+          continue
+      self._forward_sock.sendto(
+          network._FORWARD_HEADER.pack(
+              socket.inet_aton(client_addr[0]), client_addr[1]) + data,
+          (self._host or '127.0.0.1', worker.port))
+
+  def _PlaceRoom(self, room_id):
+    """Assigns a new room to the worker with the least measured load."""
+    workers = [w for w in self._workers if w.port and not w.draining]
+    if not workers:
+      return None
+    loads = [
+        load for w in workers for load in w.load_by_room_id.itervalues()]
+    room_load = sum(loads) / len(loads) if loads else 0.0
+    worker = min(
+        workers, key=lambda w: (w.EstimateLoad(room_load), len(w.room_ids)))
+    logging.info(
+        'Placing room %r on worker %d, which has load %.1f%% over %d rooms.',
+        room_id, worker.process.pid, 100 * worker.EstimateLoad(room_load),
+        len(worker.room_ids))
+    worker.room_ids.add(room_id)
+    self._worker_by_room_id[room_id] = worker
+    return worker
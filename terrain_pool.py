@@ -0,0 +1,53 @@
+"""Pre-generates terrain for upcoming rounds in a background process.
+
+Generating terrain for a large world takes long enough to stall the server's
+update loop, so a worker process keeps a few maps ready and starting a round
+only has to take one.
+"""
+
+import logging
+import multiprocessing
+import Queue
+import random
+
+import world
+
+
+def _GenerateForever(width, height, ready_queue):
+  random.seed()  # Otherwise the fork repeats the parent's random sequence.
+  while True:
+    ready_queue.put(world.GenerateTerrain(width, height))
+
+
+class TerrainPool(object):
+  def __init__(self, width, height, size):
+    """Starts a worker generating up to size maps ahead (size must be > 0)."""
+    self._width = width
+    self._height = height
+    self._ready_queue = multiprocessing.Queue(maxsize=size)
+    self._worker = multiprocessing.Process(
+        target=_GenerateForever,
+        args=(width, height, self._ready_queue))
+    self._worker.daemon = True
+    self._worker.start()
+
+    # stats on how often a round had to wait for synchronous generation
+    self.num_taken = 0
+    self.num_dry = 0
+
+  def Get(self):
+    """Returns ready Terrain, or generates it now if the pool ran dry."""
+    self.num_taken += 1
+    try:
+      return self._ready_queue.get_nowait()
+    except Queue.Empty:
+      self.num_dry += 1
+      logging.info(
+          'Terrain pool ran dry for %d of %d rounds (%d%%).',
+          self.num_dry,
+          self.num_taken,
+          int(100 * float(self.num_dry) / self.num_taken))
+      return world.GenerateTerrain(self._width, self._height)
+
+  def Close(self):
+    self._worker.terminate()
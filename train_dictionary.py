@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Trains a preset dictionary for compressing Nuke Snake network responses.
+
+Responses are recorded from AI-only games played at each of the given world
+sizes, encoded as the server would send them, and the dictionary is made of
+the byte strings most common between them (see compression.TrainDictionary).
+Give the dictionary file to both main_server.py and main_client.py.
+
+Example:
+  # Train a dictionary from games in the default world size.
+  %(prog)s -o responses.dict
+  # Train for clients with packed blocks, from several world sizes and modes.
+  %(prog)s --packed-blocks --sizes 100x30 200x50 --modes BATTLE CLEAR_MINES \\
+      -o packed.dict
+"""
+import argparse
+import logging
+import random
+
+from common import game_pb2, network_pb2
+import ai_player
+import common
+import compression
+import controller
+import network
+
+
+def RecordResponses(
+    width, height, mode, num_players, num_ticks, seed=0, packed=False):
+  """Plays an AI-only game and returns each update, serialized for sending.
+
+  Updates which would not fit in a datagram are left out, since they are
+  chunked, and compress well enough without a dictionary.
+  """
+  game = controller.Controller(width, height, mode, 0, seed=seed)
+  ai_rng = random.Random(seed)
+  ais_by_id = {}
+  for i in xrange(num_players):
+    secret = name = 'ai%d' % i
+    info = game_pb2.PlayerInfo(player_id=game.Register(secret, name), name=name)
+    ais_by_id[info.player_id] = ai_player.Player(secret, info, rng=ai_rng)
+  samples = []
+  last_hash = None
+  last_tick = None
+  for _ in xrange(num_ticks):
+    game.Step()
+    last_hash, state = game.GetGameState(last_hash)
+    if not state:
+      continue
+    response = network_pb2.Response()
+    response.CopyFrom(state)
+    if not response.full_update and last_tick is not None:
+      response.base_tick = last_tick
+    last_tick = response.tick
+    if packed:
+      response = network._PackBlocks(response)
+    data = response.SerializeToString()
+    if len(data) <= network._ProtoSocket._MAX_DATAGRAM_SIZE:
+      samples.append(data)
+    for info in state.player_info:
+      if info.alive == game_pb2.PlayerInfo.ALIVE:
+        ais_by_id[info.player_id].UpdateAndDoCommands(state, game)
+    if state.stage == game_pb2.Stage.COLLECT_PLAYERS:
+      game.Action('ai0')
+  return samples
+
+
+def _ParseSize(size_str):
+  width, _, height = size_str.partition('x')
+  return int(width), int(height)
+
+
+if __name__ == '__main__':
+  common.ConfigureLogging()
+  summary_line, _, main_doc = __doc__.partition('\n\n')
+  parser = argparse.ArgumentParser(
+      description=summary_line,
+      epilog=main_doc,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument(
+      '-o', '--output', required=True,
+      help='File to write the dictionary to.')
+  parser.add_argument(
+      '--sizes', nargs='+', type=_ParseSize, default=[(100, 30)],
+      help='World sizes to record games in, as WIDTHxHEIGHT.')
+  parser.add_argument(
+      '--modes', nargs='+', type=game_pb2.Mode.Id.Value,
+      default=[game_pb2.Mode.BATTLE],
+      help='Game modes to record: %s.' % ', '.join(game_pb2.Mode.Id.keys()))
+  parser.add_argument(
+      '--players', type=int, default=4,
+      help='Number of AI players in each game.')
+  parser.add_argument(
+      '--ticks', type=int, default=3000,
+      help='Number of ticks to record of each game.')
+  parser.add_argument(
+      '--seed', type=int, default=0,
+      help='Random seed for each game.')
+  parser.add_argument(
+      '--size', type=int, default=16384,
+      help='Most bytes in the dictionary, up to 32768.')
+  parser.add_argument(
+      '--packed-blocks', action='store_true', dest='packed_blocks',
+      help='Record responses for clients which ask for packed blocks.')
+  args = parser.parse_args()
+
+  samples = []
+  for (width, height), mode in (
+      (size, mode) for size in args.sizes for mode in args.modes):
+    samples += RecordResponses(
+        width, height, mode, args.players, args.ticks, args.seed,
+        args.packed_blocks)
+  logging.info(
+      'Training on %d responses, %d bytes.',
+      len(samples), sum(len(s) for s in samples))
+  data = compression.TrainDictionary(samples, min(args.size, 32768))
+  with open(args.output, 'wb') as f:
+    f.write(data)
+  logging.info(
+      'Wrote a %d byte dictionary, ID %08x, to %s.',
+      len(data), compression.PresetDictionary(data).dict_id, args.output)
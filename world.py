@@ -1,11 +1,14 @@
+import array
+import collections
+import heapq
 import itertools
 import logging
 import random
 
 from common import game_pb2
-import common
 import config
 import height_map
+import rockets
 
 
 # parameters for terrain generation
@@ -17,6 +20,10 @@ _NUKE_PROPORTION = 0.1
 _MAX_POS_TRIES = 50
 _POS_CLEARANCE = 2
 
+# sentinels in the terrain arrays
+_NO_PLAYER = -1
+_NO_EXPIRY = -1
+
 _B = game_pb2.Block
 def _Block(block_type, x, y):
   return _B(
@@ -24,39 +31,179 @@ def _Block(block_type, x, y):
       pos=game_pb2.Coordinate(x=x, y=y))
 
 
+def ClampSize(world_dimension):
+  return max(4, world_dimension)
+
+
+# Terrain for a round, before power-ups (whose type is chosen per round) are
+# placed. types is a column-major array of Block.Type, as in World.
+Terrain = collections.namedtuple('Terrain', ('types', 'power_up_indices'))
+
+
+def GenerateTerrain(width, height, rng=random, power_ups=True):
+  """Returns new random Terrain for a world of the given (clamped) size.
+
+  Args:
+    rng: A random.Random to draw from, or by default the random module.
+    power_ups: Whether to choose power_up_indices, else left empty.
+  """
+  types = array.array('B', [_B.EMPTY]) * (width * height)
+  def RandomIndex():
+    """Returns the index of a random cell (not in the walls)."""
+    return rng.randint(1, width - 2) * height + rng.randint(1, height - 2)
+
+  if config.TERRAIN:
+    ripple_total = rng.randint(-1, 1)
+    ripple_x = rng.randint(-1, 2)
+    ripple_y = ripple_total - ripple_x
+    logging.debug(
+        'Generating terrain with ripple (%d, %d).', ripple_x, ripple_y)
+    hm = height_map.MakeHeightMap(
+        width,
+        height,
+        0,
+        18,
+        blur_size=1,
+        ripple_amt=(ripple_x, ripple_y),
+        rng=rng)
+    for i in xrange(width):
+      for j in xrange(height):
+        if hm[i][j] >= 13:
+          types[i * height + j] = _B.ROCK
+        elif hm[i][j] >= 12:
+          types[i * height + j] = _B.TREE
+
+  if config.WALLS:
+    for x in range(0, width):
+      for y in (0, height - 1):
+        types[x * height + y] = _B.WALL
+    for y in range(0, height):
+      for x in (0, width - 1):
+        types[x * height + y] = _B.WALL
+
+  if not config.INFINITE_AMMO:
+    for _ in xrange(width * height / _AMMO_RARITY):
+      i = RandomIndex()
+      types[i] = _B.AMMO if rng.random() > _NUKE_PROPORTION else _B.NUKE
+
+  if config.MINES:
+    if config.MINE_CLUSTERS:
+      hm = height_map.MakeHeightMap(
+          width,
+          height,
+          0,
+          rng.randint(28, 30),
+          blur_size=4,
+          rng=rng)
+      for i in xrange(width):
+        for j in xrange(height):
+          if hm[i][j] >= 17 and types[i * height + j] == _B.EMPTY:
+            types[i * height + j] = _B.MINE
+    else:
+      for _ in xrange(width * height / _MINE_RARITY):
+        types[RandomIndex()] = _B.MINE
+
+  return Terrain(
+      types=types,
+      power_up_indices=[
+          RandomIndex() for _ in xrange(width * height / _POWER_UP_RARITY)]
+      if power_ups else [])
+
+
 class World(object):
-  """Blocks in the world and management for tracking diffs."""
-  def __init__(self, width, height):
+  """Blocks in the world and management for tracking diffs.
+
+  Terrain is stored column-major in flat typed arrays (one entry per cell, see
+  _Index) and only materialized as Block protos when read, e.g. for updates
+  sent to clients. Moving blocks (player heads and rockets) are protos.
+  """
+  def __init__(self, width, height, terrain_pool=None, rng=random):
+    """Makes an empty world.
+
+    Args:
+      rng: A random.Random for terrain and positions, or the random module.
+    """
+    self._rng = rng
     # Readonly, but exposed for common use in controller.
-    self.size = game_pb2.Coordinate(x=max(4, width), y=max(4, height))
-    self._updates_grid = common.MakeGrid(self.size)
+    self.size = game_pb2.Coordinate(
+        x=ClampSize(width), y=ClampSize(height))
+    self._terrain_pool = terrain_pool
+    self._num_cells = self.size.x * self.size.y
+    # Indices of cells changed since the last GenerateAndClearUpdates, so
+    # generating and resetting updates scales with activity rather than world
+    # area. After a rebuild, all cells are included instead.
+    self._updated_indices = set()
+    self._all_updated = True
     self._dirty = True
 
-    self._static_blocks_grid = common.MakeGrid(self.size)
-    self._expiring_blocks_soonest_first = []  # player tails
-    self._rockets = []
+    self._terrain_types = array.array('B', [_B.EMPTY]) * self._num_cells
+    self._terrain_player_ids = array.array('i', [_NO_PLAYER]) * self._num_cells
+    self._terrain_expiry = array.array('l', [_NO_EXPIRY]) * self._num_cells
+    # Player tails as a heap of (last_viable_tick, sequence, epoch, index).
+    # Entries which were cancelled, or whose cell has since changed, are
+    # skipped lazily when popped.
+    self._expiring_blocks_heap = []
+    self._expiring_sequence = itertools.count()
+    self._expiration_epochs_by_player_id = collections.defaultdict(int)
+    self._rockets = rockets.Rockets(self.size.x, self.size.y)
     self._player_heads_by_key = {}
+    # Number of moving blocks (heads and rockets) in each occupied cell, kept up
+    # to date as they move, for finding collisions.
+    self._moving_counts_by_index = collections.Counter()
+
+  def _Index(self, pos):
+    return pos.x * self.size.y + pos.y
+
+  def _MakeTerrainBlock(self, i):
+    """Returns a Block for the terrain in a cell, or None if it is empty."""
+    block_type = self._terrain_types[i]
+    if block_type == _B.EMPTY:
+      return None
+    block = _Block(block_type, i / self.size.y, i % self.size.y)
+    player_id = self._terrain_player_ids[i]
+    if player_id != _NO_PLAYER:
+      block.player_id = player_id
+    return block
 
   def GenerateAndClearUpdates(self):
+    """Yields blocks changed since the last call.
+
+    After a rebuild this is a full snapshot instead (see all_updated), which
+    leaves out empty cells.
+    """
+    moving_by_index = {}
     for moving in itertools.chain(
-        self._player_heads_by_key.itervalues(), self._rockets):
-      self._updates_grid[moving.pos.x][moving.pos.y] = moving
-    for row in self._updates_grid:
-      for block in row:
-        if block:
-          yield block
-    self._updates_grid = common.MakeGrid(self.size)
+        self._player_heads_by_key.itervalues(), self.IterAllRockets()):
+      moving_by_index[self._Index(moving.pos)] = moving
+    if self._all_updated:
+      for i, block_type in enumerate(self._terrain_types):
+        if block_type != _B.EMPTY and i not in moving_by_index:
+          yield self._MakeTerrainBlock(i)
+    else:
+      for i in self._updated_indices:
+        if i not in moving_by_index:
+          yield self._MakeTerrainBlock(i) or _Block(
+              _B.EMPTY, i / self.size.y, i % self.size.y)
+    for block in moving_by_index.itervalues():
+      yield block
+    self._updated_indices.clear()
+    self._all_updated = False
     self._dirty = False
 
   @property
   def dirty(self):
     return self._dirty
 
+  @property
+  def all_updated(self):
+    """Whether the next updates are a full snapshot, as after a rebuild."""
+    return self._all_updated
+
   def _GetRandomPos(self):
     """Returns a random coordinate within the world (and not in the walls)."""
     return game_pb2.Coordinate(
-      x=random.randint(1, self.size.x - 2),
-      y=random.randint(1, self.size.y - 2))
+      x=self._rng.randint(1, self.size.x - 2),
+      y=self._rng.randint(1, self.size.y - 2))
 
   def GetRandomPosClearOfTerrain(self):
     tries = 0
@@ -67,102 +214,90 @@ class World(object):
       tries += 1
       for dx in xrange(-_POS_CLEARANCE, _POS_CLEARANCE + 1):
         for dy in xrange(-_POS_CLEARANCE, _POS_CLEARANCE + 1):
-          hit = self._static_blocks_grid[
-              (starting_pos.x + dx) % self.size.x][
+          hit = self._terrain_types[
+              ((starting_pos.x + dx) % self.size.x) * self.size.y +
               (starting_pos.y + dy) % self.size.y]
-          if hit is not None:
+          if hit != _B.EMPTY:
             collides = True
             break
     if collides:
       logging.info(
           'Did not find a starting position with %d clearance after %d tries.',
           _POS_CLEARANCE, _MAX_POS_TRIES)
-      self._static_blocks_grid[starting_pos.x][starting_pos.y] = None
+      self.ClearTerrain(starting_pos)
     return starting_pos
 
   def IterAllTerrainBlocks(self):
     """Yields all terrain blocks, for scoring analysis."""
-    for row in self._static_blocks_grid:
-      for block in row:
-        if block:
-          yield block
+    for i, block_type in enumerate(self._terrain_types):
+      if block_type != _B.EMPTY:
+        yield self._MakeTerrainBlock(i)
+
+  def IterAllBlocks(self):
+    """Yields terrain and then moving blocks, as a full snapshot."""
+    return itertools.chain(
+        self.IterAllTerrainBlocks(),
+        self.IterAllPlayerHeads(),
+        self.IterAllRockets())
+
+  def IterBlocksInRect(self, x0, y0, x1, y1):
+    """Yields terrain and then moving blocks with x0 <= x < x1, y0 <= y < y1."""
+    h = self.size.y
+    types = self._terrain_types
+    for x in xrange(x0, x1):
+      start = x * h + y0
+      for i, block_type in enumerate(types[start:x * h + y1], start):
+        if block_type != _B.EMPTY:
+          yield self._MakeTerrainBlock(i)
+    for head in self._player_heads_by_key.itervalues():
+      if x0 <= head.pos.x < x1 and y0 <= head.pos.y < y1:
+        yield head
+    r = self._rockets
+    for i, (x, y) in enumerate(itertools.izip(r.xs, r.ys)):
+      if x0 <= x < x1 and y0 <= y < y1:
+        yield r.MakeBlock(i)
 
   def ClearBlocksAndRebuildTerrain(self, power_up_type):
-    self._static_blocks_grid = common.MakeGrid(self.size)
-    self._rockets = []
-
-    if config.TERRAIN:
-      ripple_total = random.randint(-1, 1)
-      ripple_x = random.randint(-1, 2)
-      ripple_y = ripple_total - ripple_x
-      logging.debug(
-          'Generating terrain with ripple (%d, %d).', ripple_x, ripple_y)
-      hm = height_map.MakeHeightMap(
-          self.size.x,
-          self.size.y,
-          0,
-          18,
-          blur_size=1,
-          ripple_amt=(ripple_x, ripple_y))
-      for i in xrange(self.size.x):
-        for j in xrange(self.size.y):
-          if hm[i][j] >= 13:
-            self._static_blocks_grid[i][j] = _Block(_B.ROCK, i, j)
-          elif hm[i][j] >= 12:
-            self._static_blocks_grid[i][j] = _Block(_B.TREE, i, j)
-
-    if config.WALLS:
-      for x in range(0, self.size.x):
-        for y in (0, self.size.y - 1):
-          self._static_blocks_grid[x][y] = _Block(_B.WALL, x, y)
-      for y in range(0, self.size.y):
-        for x in (0, self.size.x - 1):
-          self._static_blocks_grid[x][y] = _Block(_B.WALL, x, y)
-
-    if not config.INFINITE_AMMO:
-      for _ in xrange(self.size.x * self.size.y / _AMMO_RARITY):
-        pos = self._GetRandomPos()
-        self._static_blocks_grid[pos.x][pos.y] = _B(
-            type=_B.AMMO if random.random() > _NUKE_PROPORTION else _B.NUKE,
-            pos=pos)
-
-    if config.MINES:
-      if config.MINE_CLUSTERS:
-        hm = height_map.MakeHeightMap(
-            self.size.x,
-            self.size.y,
-            0,
-            random.randint(28, 30),
-            blur_size=4)
-        for i in xrange(self.size.x):
-          for j in xrange(self.size.y):
-            if hm[i][j] >= 17 and self._static_blocks_grid[i][j] is None:
-              self._static_blocks_grid[i][j] = _Block(_B.MINE, i, j)
-      else:
-        for _ in xrange(self.size.x * self.size.y / _MINE_RARITY):
-          pos = self._GetRandomPos()
-          self._static_blocks_grid[pos.x][pos.y] = _B(type=_B.MINE, pos=pos)
-
+    """Starts a new round's terrain, from the terrain pool if there is one."""
+    if self._terrain_pool:
+      terrain = self._terrain_pool.Get()
+    else:
+      terrain = GenerateTerrain(
+          self.size.x, self.size.y, self._rng,
+          power_ups=power_up_type is not None)
+    types = terrain.types
     if power_up_type is not None:
-      for _ in xrange(self.size.x * self.size.y / _POWER_UP_RARITY):
-        pos = self._GetRandomPos()
-        self._static_blocks_grid[pos.x][pos.y] = _B(type=power_up_type, pos=pos)
-
-    self._updates_grid = common.MakeGrid(self.size)
-    for i in xrange(self.size.x):
-      for j in xrange(self.size.y):
-        self._updates_grid[i][j] = (
-            self._static_blocks_grid[i][j] or _Block(_B.EMPTY, i, j))
+      for i in terrain.power_up_indices:
+        types[i] = power_up_type
+    self._expiring_blocks_heap = []
+    self._rockets.Clear()
+    self._moving_counts_by_index = collections.Counter(
+        self._Index(head.pos)
+        for head in self._player_heads_by_key.itervalues())
+
+    self._terrain_types = types
+    self._terrain_player_ids = array.array('i', [_NO_PLAYER]) * self._num_cells
+    self._terrain_expiry = array.array('l', [_NO_EXPIRY]) * self._num_cells
+    self._updated_indices.clear()
+    self._all_updated = True
     self._dirty = True
 
   def SetTerrain(self, block):
     """Sets a new block in the terrain."""
-    self._updates_grid[block.pos.x][block.pos.y] = block
-    self._static_blocks_grid[block.pos.x][block.pos.y] = (
-        None if block.type == _B.EMPTY else block)
+    i = self._Index(block.pos)
+    self._terrain_types[i] = block.type
+    self._terrain_player_ids[i] = (
+        block.player_id if block.HasField('player_id') else _NO_PLAYER)
     if block.HasField('last_viable_tick'):
-      self._expiring_blocks_soonest_first.append(block)
-      self._expiring_blocks_soonest_first.sort(key=lambda b: b.last_viable_tick)
+      self._terrain_expiry[i] = block.last_viable_tick
+      heapq.heappush(self._expiring_blocks_heap, (
+          block.last_viable_tick,
+          next(self._expiring_sequence),
+          self._expiration_epochs_by_player_id[block.player_id],
+          i))
+    else:
+      self._terrain_expiry[i] = _NO_EXPIRY
+    self._updated_indices.add(i)
     self._dirty = True
 
   def ClearTerrain(self, pos):
@@ -171,48 +306,103 @@ class World(object):
 
   def GetTerrain(self, pos):
     """Gets the terrain block at a coordinate. None if no block is there."""
-    return self._static_blocks_grid[pos.x][pos.y]
-
-  def StopTerrainExpiration(self, filter_fn):
-    rm_indices = []
-    for i, b in enumerate(self._expiring_blocks_soonest_first):
-      if filter_fn(b):
-        b.ClearField('last_viable_tick')
-        rm_indices.append(i)
-    for i in reversed(rm_indices):
-      del self._expiring_blocks_soonest_first[i]
+    return self._MakeTerrainBlock(self._Index(pos))
+
+  def IterCrowdedMovingBlocks(self, heads):
+    """Yields (block, rocket_index) for moving blocks which are not alone.
+
+    A moving block is not alone if terrain or another moving block (whether or
+    not among the given heads) is in the same cell. The given heads come first,
+    with a rocket_index of None, followed by rockets.
+    """
+    counts = self._moving_counts_by_index
+    types = self._terrain_types
+    for head in heads:
+      i = self._Index(head.pos)
+      if counts[i] > 1 or types[i] != _B.EMPTY:
+        yield head, None
+    h = self.size.y
+    for r, (x, y) in enumerate(
+        itertools.izip(self._rockets.xs, self._rockets.ys)):
+      i = x * h + y
+      if counts[i] > 1 or types[i] != _B.EMPTY:
+        yield self._rockets.MakeBlock(r), r
+
+  def _AddMoving(self, pos):
+    self._moving_counts_by_index[self._Index(pos)] += 1
+
+  def _RemoveMoving(self, pos):
+    self._RemoveMovingAtIndices((self._Index(pos),))
+
+  def _RemoveMovingAtIndices(self, indices):
+    counts = self._moving_counts_by_index
+    for i in indices:
+      counts[i] -= 1
+      if not counts[i]:
+        del counts[i]
+
+  def StopTerrainExpiration(self, player_id):
+    """Makes all of a player's expiring terrain (their tail) permanent."""
+    self._expiration_epochs_by_player_id[player_id] += 1
 
   def IterAllRockets(self):
-    return iter(self._rockets)
+    for r in xrange(len(self._rockets)):
+      yield self._rockets.MakeBlock(r)
+
+  def AddRocket(self, x, y, dx, dy, player_id, last_viable_tick):
+    self._rockets.Add(x, y, dx, dy, player_id, last_viable_tick)
+    self._moving_counts_by_index[x * self.size.y + y] += 1
+    self._dirty = True
 
-  def AddRocket(self, rocket):
-    self._rockets.append(rocket)
-    self._updates_grid[rocket.pos.x][rocket.pos.y] = rocket
+  def AdvanceRockets(self):
+    h = self.size.y
+    vacated = [
+        x * h + y for x, y in itertools.izip(self._rockets.xs, self._rockets.ys)]
+    self._updated_indices.update(vacated)
+    self._RemoveMovingAtIndices(vacated)
+    self._rockets.Advance()
+    self._moving_counts_by_index.update(
+        x * h + y for x, y in itertools.izip(self._rockets.xs, self._rockets.ys))
     self._dirty = True
 
-  def _UpdateAsEmpty(self, pos):
-    self._updates_grid[pos.x][pos.y] = _Block(_B.EMPTY, pos.x, pos.y)
+  def KillRocket(self, rocket_index):
+    """Flags a rocket for removal at the next ExpireBlocks."""
+    self._rockets.Kill(rocket_index)
+
+  def _UpdateAsVacated(self, pos):
+    """Records that a moving block left a cell, revealing the terrain."""
+    self._updated_indices.add(self._Index(pos))
     self._dirty = True
 
   def AdvanceBlock(self, b):
-    self._UpdateAsEmpty(b.pos)
+    self._UpdateAsVacated(b.pos)
+    self._RemoveMoving(b.pos)
     b.pos.x = (b.pos.x + b.direction.x) % self.size.x
     b.pos.y = (b.pos.y + b.direction.y) % self.size.y
+    self._AddMoving(b.pos)
     # Moving blocks (player heads and rockets) are always included in updates.
     self._dirty = True
 
   def ExpireBlocks(self, tick):
-    rm_indices = []
-    for i, rocket in enumerate(self._rockets):
-      if rocket.last_viable_tick < tick:
-        rm_indices.append(i)
-        self._UpdateAsEmpty(rocket.pos)
-    for i in reversed(rm_indices):
-      del self._rockets[i]
-
-    expiring = self._expiring_blocks_soonest_first
-    while expiring and expiring[0].last_viable_tick < tick:
-      self.ClearTerrain(expiring.pop(0).pos)
+    h = self.size.y
+    vacated = [x * h + y for x, y in self._rockets.Expire(tick)]
+    if vacated:
+      self._updated_indices.update(vacated)
+      self._RemoveMovingAtIndices(vacated)
+      self._dirty = True
+
+    expiring = self._expiring_blocks_heap
+    while expiring and expiring[0][0] < tick:
+      last_viable_tick, _, epoch, i = heapq.heappop(expiring)
+      if self._terrain_expiry[i] != last_viable_tick:
+        continue  # The cell was cleared or reused since.
+      self._terrain_expiry[i] = _NO_EXPIRY
+      player_id = self._terrain_player_ids[i]
+      if epoch == self._expiration_epochs_by_player_id[player_id]:
+        self._terrain_types[i] = _B.EMPTY
+        self._terrain_player_ids[i] = _NO_PLAYER
+        self._updated_indices.add(i)
+        self._dirty = True
 
   def GetPlayerHead(self, key):
     return self._player_heads_by_key.get(key)
@@ -223,24 +413,26 @@ class World(object):
       raise KeyError('No player head for %s.' % key)
     head.pos.MergeFrom(pos)
     self._player_heads_by_key[key] = head
-    self._updates_grid[head.pos.x][head.pos.y] = head
+    self._AddMoving(head.pos)
     self._dirty = True
 
   def SetPlayerHead(self, key, head):
     self.RemovePlayerHead(key)
     self._player_heads_by_key[key] = head
-    self._updates_grid[head.pos.x][head.pos.y] = head
+    self._AddMoving(head.pos)
     self._dirty = True
 
   def RemoveAllPlayerHeads(self):
     for head in self._player_heads_by_key.itervalues():
-      self._UpdateAsEmpty(head.pos)
+      self._UpdateAsVacated(head.pos)
+      self._RemoveMoving(head.pos)
     self._player_heads_by_key = {}
 
   def RemovePlayerHead(self, key):
     head = self._player_heads_by_key.pop(key, None)
     if head:
-      self._UpdateAsEmpty(head.pos)
+      self._UpdateAsVacated(head.pos)
+      self._RemoveMoving(head.pos)
     return head
 
   def IterAllPlayerHeads(self):